@@ -0,0 +1,22 @@
+'''
+Compare the per-call overhead of Figure.set against a BoundProperty. No viewer
+is needed: messages are published to no-one, so only the client side cost is
+measured.
+'''
+import pynutmeg
+import numpy as np
+import timeit
+
+nutmeg = pynutmeg.Nutmeg()
+# Pretend a viewer has connected so messages are actually sent
+nutmeg.state_requested = True
+
+fig = nutmeg.figure('bench', 'Figure {}')
+y = fig.bind('ax.blue.y')
+
+N = 20000
+for name, value in [('scalar', 1.5), ('array(16)', np.random.standard_normal(16))]:
+    t_set = timeit.timeit(lambda: fig.set('ax.blue.y', value), number=N) / N
+    t_bind = timeit.timeit(lambda: y.set(value), number=N) / N
+    print("{:>10}: Figure.set {:6.2f} us, bound {:6.2f} us ({:.1f}x)".format(
+        name, t_set*1e6, t_bind*1e6, t_set/t_bind))
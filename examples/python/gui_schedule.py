@@ -0,0 +1,31 @@
+import pynutmeg
+import time
+import numpy as np
+
+fig = pynutmeg.figure("test", '../figures/figure_single.qml')
+fig.set_gui('../gui/gui1.qml')
+
+sld = fig.parameter('sigma')
+sld.set(maximumValue=20)
+
+# Deliberately heavy per-frame compute
+data = np.random.standard_normal(2000000)
+def get_y(sigma):
+    if sigma == 0:
+        return data
+
+    m = int(np.ceil(sigma))
+    N = 2*m + 1
+    window = np.interp(np.linspace(-m,m,N), [-sigma, 0, sigma], [0, 1, 0])
+    window /= window.sum()
+    return np.convolve(data, window, mode='same')
+
+fig.set('ax', minY=-3, maxY=3)
+
+# Recompute on a worker thread whenever sigma changes. Values that change
+# while a computation is running are coalesced, and stale results are dropped.
+sched = fig.schedule('ax.blue.y', get_y, sld)
+
+while True:
+    time.sleep(0.5)
+    fig.nutmeg.check_errors()
@@ -0,0 +1,17 @@
+import pynutmeg
+from pynutmeg.LOD import LODSeries, LODPlot
+import numpy as np
+import time
+
+fig = pynutmeg.figure('lod', '../figures/figure_single.qml')
+
+# A long random walk. For really large traces, pass an np.memmap instead.
+y = np.cumsum(np.random.standard_normal(50000000).astype(np.float32))
+series = LODSeries(y)
+plot = LODPlot(fig, 'ax.blue', series, axis='ax', max_points=4000)
+
+# Zoom in on the middle of the trace, never sending more than 4000 points
+center = len(y) // 2
+for width in np.geomspace(len(y), 1000, 60):
+    plot.show(center - width/2, center + width/2, set_limits=True)
+    time.sleep(0.05)
@@ -0,0 +1,19 @@
+import pynutmeg
+from pynutmeg import ParallelNutmeg
+import numpy as np
+
+
+def sweep(seed):
+    # Inside the worker, pynutmeg forwards everything to the parent process
+    fig = pynutmeg.figure('worker{}'.format(seed), '../figures/figure_single.qml')
+    rng = np.random.RandomState(seed)
+    walk = np.cumsum(rng.standard_normal(20000))
+    for i in range(100, len(walk), 100):
+        fig.set('ax.blue', y=walk[:i])
+    return walk[-1]
+
+
+if __name__ == '__main__':
+    pynutmeg.init()
+    pynutmeg.wait_for_nutmeg()
+    print(ParallelNutmeg.parallelize(sweep, range(4), maxProcesses=4, relay=True))
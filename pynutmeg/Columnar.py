@@ -0,0 +1,176 @@
+'''
+Conversion of columnar data to arrays that can be sent as binary frames
+without copying: NumPy structured arrays, and pandas and pyarrow objects when
+those libraries are in use. Also Packed frames of many series.
+
+pandas and pyarrow are never imported here. If the caller hasn't imported
+them, they can't have given us one of their objects.
+'''
+from __future__ import print_function, division
+import numpy as np
+
+import sys
+
+from .Lanes import Stream
+
+
+class Packed(object):
+    '''
+    Many series packed into a single contiguous binary frame.
+
+    The data can be a 2-D array with one series per row, a structured array
+    with one series per field, or a list of 1-D arrays, which may differ in
+    length and are concatenated. Contiguous arrays are handed over without
+    being copied.
+
+    The frame's header describes where each series sits in the frame, in bytes:
+    ```
+    {"type": "packed", "size": 24000, "series": [{"offset": 0, "stride": 8, "length": 1000, "type": "float64"}, ...]}
+    ```
+    '''
+    def __init__(self, data):
+        if isinstance(data, np.ndarray) and data.dtype.names is not None:
+            data = np.ascontiguousarray(data.reshape(-1))
+            self.names = list(data.dtype.names)
+            self.series = [ dict(name=name, offset=data.dtype.fields[name][1], stride=data.dtype.itemsize,
+                                 length=len(data), type=str(data.dtype.fields[name][0]))
+                            for name in self.names ]
+
+        elif isinstance(data, np.ndarray):
+            if data.ndim != 2:
+                raise ValueError("Packed arrays must be 2-D, one series per row")
+            data = np.ascontiguousarray(data)
+            self.names = None
+            length, itemsize = data.shape[1], data.dtype.itemsize
+            self.series = [ dict(offset=i*length*itemsize, stride=itemsize, length=length, type=str(data.dtype))
+                            for i in range(len(data)) ]
+
+        else:
+            arrays = [ np.asarray(array).reshape(-1) for array in data ]
+            data = np.concatenate(arrays) if arrays else np.empty(0)
+            self.names = None
+            itemsize = data.dtype.itemsize
+            offsets = np.cumsum([0] + [ len(array) for array in arrays ])
+            self.series = [ dict(offset=int(offsets[i])*itemsize, stride=itemsize, length=len(array), type=str(data.dtype))
+                            for i, array in enumerate(arrays) ]
+
+        self.data = data
+
+    def __len__(self):
+        return len(self.series)
+
+    def header(self):
+        return dict(type='packed', size=self.data.nbytes, series=self.series)
+
+    def buffer(self):
+        return memoryview(self.data.reshape(-1).view(np.uint8))
+
+
+def _module(name):
+    return sys.modules.get(name)
+
+
+def is_columnar(value):
+    '''
+    Whether `value` is a column or table that `to_array` or `columns` understands.
+    '''
+    if isinstance(value, np.ndarray):
+        return value.dtype.names is not None
+
+    pd = _module('pandas')
+    if pd is not None and isinstance(value, (pd.Series, pd.Index, pd.DataFrame)):
+        return True
+
+    pa = _module('pyarrow')
+    if pa is not None and isinstance(value, (pa.Array, pa.ChunkedArray, pa.Table, pa.RecordBatch)):
+        return True
+
+    return False
+
+
+def columns(value):
+    '''
+    Split a table into an ordered dict of name -> column, or return None if
+    `value` isn't a table. Structured arrays, pandas DataFrames and pyarrow
+    Tables/RecordBatches are tables.
+    '''
+    if isinstance(value, np.ndarray):
+        if value.dtype.names is None:
+            return None
+        return { name: value[name] for name in value.dtype.names }
+
+    pd = _module('pandas')
+    if pd is not None and isinstance(value, pd.DataFrame):
+        return { str(name): value[name] for name in value.columns }
+
+    pa = _module('pyarrow')
+    if pa is not None and isinstance(value, (pa.Table, pa.RecordBatch)):
+        return { name: value.column(i) for i, name in enumerate(value.schema.names) }
+
+    return None
+
+
+def to_array(value):
+    '''
+    Convert a single column to an ndarray, sharing its buffer where possible,
+    or to a Stream for columns made of several chunks. Return None if `value`
+    isn't a column.
+    '''
+    pd = _module('pandas')
+    if pd is not None and isinstance(value, (pd.Series, pd.Index)):
+        return _pandas_array(value)
+
+    pa = _module('pyarrow')
+    if pa is not None:
+        if isinstance(value, pa.ChunkedArray):
+            if value.num_chunks == 1:
+                return _arrow_array(value.chunk(0))
+            # Send the chunks as they are rather than concatenating them
+            return Stream(_arrow_array(chunk) for chunk in value.chunks)
+        if isinstance(value, pa.Array):
+            return _arrow_array(value)
+
+    return None
+
+
+def to_numpy(value):
+    '''
+    Convert a column to a single ndarray, concatenating any chunks, or a table
+    to a dict of them. Used where the data is kept rather than sent straight
+    away. Return None if `value` isn't columnar.
+    '''
+    if isinstance(value, np.ndarray):
+        return value
+
+    table = columns(value)
+    if table is not None:
+        return { name: to_numpy(column) for name, column in table.items() }
+
+    pa = _module('pyarrow')
+    if pa is not None and isinstance(value, pa.ChunkedArray):
+        return _arrow_array(value.combine_chunks())
+
+    return to_array(value)
+
+
+def _pandas_array(series):
+    if isinstance(series.dtype, np.dtype):
+        # Plain NumPy backed column, this is a view
+        return series.to_numpy(copy=False)
+
+    # Extension types (nullable integers, categoricals...) have no NumPy
+    # buffer to share. Use floats with NaN for missing values if they're numeric.
+    try:
+        return series.to_numpy(dtype=np.float64, na_value=np.nan)
+    except (TypeError, ValueError):
+        return series.to_numpy(dtype=object)
+
+
+def _arrow_array(array):
+    if array.null_count == 0:
+        try:
+            # Primitive types without nulls share the Arrow buffer
+            return array.to_numpy(zero_copy_only=True)
+        except Exception:
+            pass
+    return array.to_numpy(zero_copy_only=False)
@@ -0,0 +1,223 @@
+from __future__ import print_function, division
+import numpy as np
+
+import os
+
+
+def _reduce(src_min, src_max, dst_min, dst_max, block, chunk):
+    '''
+    Fill dst with the min/max over consecutive blocks of src, working through
+    src in chunks so memory-mapped sources are never fully loaded.
+    '''
+    chunk = max(block, chunk - chunk % block)
+    n = len(src_min)
+    for start in range(0, n, chunk):
+        seg_min = np.asarray(src_min[start:start + chunk])
+        seg_max = seg_min if src_max is src_min else np.asarray(src_max[start:start + chunk])
+        index = np.arange(0, len(seg_min), block)
+        out = slice(start // block, start // block + len(index))
+        # fmin/fmax ignore NaNs, so gaps in the data don't swallow whole blocks
+        dst_min[out] = np.fmin.reduceat(seg_min, index)
+        dst_max[out] = np.fmax.reduceat(seg_max, index)
+
+
+class LODSeries(object):
+    '''
+    Multi-resolution level-of-detail index for a very long 1-D series.
+
+    A pyramid of min/max envelopes is precomputed over `y`. Level 0 is the
+    raw data, level 1 takes the min and max over blocks of `base` samples, and
+    each level after that over `factor` times as many. A query for an x range
+    then returns at most `max_points` points from the finest level that fits,
+    so the bytes sent per update stay bounded however much data is in view.
+
+    `y` may be an np.memmap, in which case it is read in chunks, and the
+    pyramid itself can be kept in memory-mapped files under `cache_dir`.
+    '''
+    def __init__(self, y, x=None, x0=0.0, dx=1.0, base=16, factor=4, min_length=1024, chunk=1 << 22, cache_dir=None):
+        '''
+        :param y: 1-D array-like of samples, e.g. an np.memmap.
+        :param x: Optional monotonically increasing 1-D array of sample positions. If None, sample i is at `x0 + i*dx`.
+        :param base: Samples per block in the first level.
+        :param factor: Blocks of each level combined into one block of the next.
+        :param min_length: Stop adding levels once a level has at most this many blocks.
+        :param chunk: Number of samples processed at a time while building.
+        :param cache_dir: If given, store the pyramid as memory-mapped files in this directory.
+        '''
+        if len(np.shape(y)) != 1:
+            raise ValueError("LODSeries expects 1-D data")
+        if x is not None and len(x) != len(y):
+            raise ValueError("x and y must be the same length")
+
+        self.y = y
+        self.x = x
+        self.x0 = x0
+        self.dx = dx
+        self.n = len(y)
+        self.base = base
+        self.factor = factor
+        self.cache_dir = cache_dir
+
+        dtype = np.asarray(y[:1]).dtype
+        # Level i (i > 0) covers blocks of self.blocks[i] samples
+        self.blocks = [1]
+        self.mins = [y]
+        self.maxs = [y]
+
+        block = base
+        src_min, src_max, reduce_by = y, y, base
+        while True:
+            length = (len(src_min) + reduce_by - 1) // reduce_by
+            level = len(self.blocks)
+            dst_min = self._alloc('min{}'.format(level), length, dtype)
+            dst_max = self._alloc('max{}'.format(level), length, dtype)
+            _reduce(src_min, src_max, dst_min, dst_max, reduce_by, chunk)
+
+            self.blocks.append(block)
+            self.mins.append(dst_min)
+            self.maxs.append(dst_max)
+
+            if length <= min_length or length == 1:
+                break
+            src_min, src_max, reduce_by = dst_min, dst_max, factor
+            block *= factor
+
+    def _alloc(self, name, length, dtype):
+        if self.cache_dir is None:
+            return np.empty(length, dtype)
+        path = os.path.join(self.cache_dir, 'lod_{}.dat'.format(name))
+        return np.memmap(path, dtype=dtype, mode='w+', shape=(length,))
+
+    def index_of(self, x):
+        '''
+        Sample index at or after position `x`, clipped to the data.
+        '''
+        if self.x is None:
+            i = int(np.ceil((x - self.x0) / self.dx))
+        else:
+            i = int(np.searchsorted(self.x, x))
+        return min(max(i, 0), self.n)
+
+    def position(self, index):
+        '''
+        X position of the samples at `index`.
+        '''
+        if self.x is None:
+            return self.x0 + np.asarray(index) * self.dx
+        return np.asarray(self.x[index])
+
+    def level_for(self, count, max_points):
+        '''
+        The finest level that shows `count` samples in at most `max_points` points.
+        '''
+        if count <= max_points:
+            return 0
+        for level in range(1, len(self.blocks)):
+            if 2 * (count // self.blocks[level] + 2) <= max_points:
+                return level
+        return len(self.blocks) - 1
+
+    def query(self, x_min=None, x_max=None, max_points=4000):
+        '''
+        Return (x, y) for the range [x_min, x_max] with at most about `max_points`
+        points. Above level 0, each block is drawn as a vertical segment from
+        its min to its max.
+        '''
+        i0 = 0 if x_min is None else self.index_of(x_min)
+        i1 = self.n if x_max is None else self.index_of(x_max)
+        # Include a sample either side so lines reach the edges of the view
+        i0 = max(i0 - 1, 0)
+        i1 = min(i1 + 1, self.n)
+
+        level = self.level_for(i1 - i0, max_points)
+        if level == 0:
+            x = self.position(np.arange(i0, i1))
+            return x, np.asarray(self.y[i0:i1])
+
+        block = self.blocks[level]
+        b0 = i0 // block
+        b1 = min((i1 + block - 1) // block, len(self.mins[level]))
+        mins = np.asarray(self.mins[level][b0:b1])
+        maxs = np.asarray(self.maxs[level][b0:b1])
+
+        # Even the coarsest level can have more blocks than max_points allows,
+        # in which case neighbouring blocks are combined here
+        starts = np.arange(b0, b1)
+        group = max(1, -(-2 * (b1 - b0) // max_points))
+        if group > 1:
+            index = np.arange(0, b1 - b0, group)
+            mins = np.fmin.reduceat(mins, index)
+            maxs = np.fmax.reduceat(maxs, index)
+            starts = starts[index]
+
+        centers = np.minimum(starts * block + block * group // 2, self.n - 1)
+        x = np.repeat(self.position(centers), 2)
+        y = np.empty(2 * len(mins), mins.dtype)
+        y[0::2] = mins
+        y[1::2] = maxs
+        return x, y
+
+
+class LODPlot(object):
+    '''
+    Keep a LinePlot showing an LODSeries at the right resolution for the view.
+
+    The view can be driven from Python with `show`, which can also set the
+    axis' minX/maxX, or by the viewer through a Gui parameter whose value is
+    [minX, maxX] with `follow`.
+
+    For example:
+    ```
+    series = LODSeries(np.memmap('trace.f32', np.float32, 'r'))
+    plot = LODPlot(fig, 'ax.data', series)
+    plot.show(0, 1e6, set_limits=True)
+    plot.follow(fig.parameter('viewRange'))
+    ```
+    '''
+    def __init__(self, figure, handle, series, axis='ax', max_points=4000):
+        '''
+        :param figure: Figure that the plot is in.
+        :param handle: Handle of the LinePlot in the figure.
+        :param axis: Handle of the Axis whose limits are set by `show(..., set_limits=True)`.
+        :param max_points: Upper bound on points sent per update.
+        '''
+        self.figure = figure
+        self.handle = handle
+        self.series = series
+        self.axis = axis
+        self.max_points = max_points
+        self.scheduler = None
+
+    def show(self, x_min=None, x_max=None, set_limits=False):
+        '''
+        Send the data for the range [x_min, x_max].
+        '''
+        x, y = self.series.query(x_min, x_max, self.max_points)
+        self.figure.set(self.handle, x=x, y=y)
+        if set_limits and x_min is not None and x_max is not None:
+            self.figure.set(self.axis, minX=x_min, maxX=x_max)
+
+    def follow(self, param, **kwargs):
+        '''
+        Update whenever `param`, holding [minX, maxX], changes. Queries run
+        on a ComputeScheduler so only the latest view range is ever sent.
+        :param **kwargs: Passed on to ComputeScheduler.
+        '''
+        from .Scheduler import ComputeScheduler
+
+        def query(view):
+            if not view:
+                return self.series.query(max_points=self.max_points)
+            return self.series.query(view[0], view[1], self.max_points)
+
+        def output(result):
+            self.figure.set(self.handle, x=result[0], y=result[1])
+
+        self.stop()
+        self.scheduler = ComputeScheduler(query, [param], output, **kwargs)
+        return self.scheduler
+
+    def stop(self):
+        if self.scheduler is not None:
+            self.scheduler.stop()
+            self.scheduler = None
@@ -0,0 +1,360 @@
+from __future__ import print_function, division
+import numpy as np
+
+import os
+import itertools
+import threading
+import traceback
+
+from collections import deque
+
+from zmq.utils import jsonapi
+
+
+# Priority lanes, lower is sent first
+HIGH = 0
+NORMAL = 1
+BULK = 2
+
+# Commands which are latency sensitive, or which later messages depend on
+_high_commands = ('Ping', 'SetParam', 'SetFigure', 'SetGui')
+
+_chunk_size = 1 << 18
+
+
+_stream_ids = itertools.count()
+
+
+def nbytes(data):
+    if isinstance(data, Stream):
+        return data.nbytes
+    return memoryview(data).nbytes
+
+
+def classify(msg, binary_data, chunk_size=_chunk_size):
+    '''
+    Pick the priority lane for a message based on its command and the size of
+    its binary payload.
+    '''
+    if msg['command'] in _high_commands:
+        return HIGH
+    if any(isinstance(data, Stream) for data in binary_data):
+        return BULK
+
+    size = sum(nbytes(data) for data in binary_data)
+    if size == 0:
+        return HIGH
+    elif size <= chunk_size:
+        return NORMAL
+    else:
+        return BULK
+
+
+class Stream(object):
+    '''
+    Array data which is read and sent in bounded-size chunks, rather than
+    being turned into a single bytes object, so peak memory stays roughly
+    constant however large the data is.
+
+    The source can be an np.memmap (or any ndarray), a path to a raw binary
+    file with its `dtype` and optionally `shape`, or an iterable of chunks
+    (arrays or bytes) which are concatenated along the first axis.
+
+    Arrays and files can be read again when the state is replayed. Iterables
+    can only be read once, so they are sent but not kept in the state.
+
+    For example:
+    ```
+    fig.set('ax.data', y=Stream('trace.f32', dtype=np.float32))
+    fig.set('ax.data', y=Stream(chunk for chunk in reader), progress=print)
+    ```
+    When lanes are in use, np.memmap arrays larger than the chunk size are
+    streamed automatically. Otherwise they're sent whole like any array.
+    '''
+    def __init__(self, source, dtype=None, shape=None, offset=0, chunk_size=None, progress=None):
+        '''
+        :param source: np.ndarray, file path, or iterable of chunks.
+        :param dtype: Data type of a file or iterable source.
+        :param shape: Shape of a file source. Defaults to 1-D over the whole file.
+        :param offset: Byte offset of the data in a file source.
+        :param chunk_size: Maximum size of each chunk in bytes. Defaults to the chunk size of the Nutmeg sending it, and is never larger.
+        :param progress: Called with (bytes sent, total bytes or None) after each chunk.
+        '''
+        self.source = source
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.shape = shape
+        self.offset = offset
+        self.chunk_size = chunk_size
+        self.progress = progress
+
+        if isinstance(source, np.ndarray):
+            self.dtype = source.dtype
+            self.shape = source.shape
+            self.replayable = True
+        elif isinstance(source, str):
+            if self.dtype is None:
+                raise ValueError("A dtype is needed to stream from a file")
+            if self.shape is None:
+                size = os.path.getsize(source) - offset
+                self.shape = (size // self.dtype.itemsize,)
+            self.replayable = True
+        else:
+            self.replayable = False
+
+    @property
+    def nbytes(self):
+        if self.shape is None or self.dtype is None:
+            return None
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def header(self):
+        dtype = None if self.dtype is None else str(self.dtype)
+        shape = None if self.shape is None else tuple(self.shape)
+        return dict(type=dtype, shape=shape)
+
+    def chunks(self, chunk_size=_chunk_size):
+        '''
+        Generate the data as buffers of at most `chunk_size` bytes, or the
+        Stream's own chunk size if that's smaller. For iterables, dtype and
+        shape are known once this is exhausted.
+        '''
+        if self.chunk_size is not None:
+            chunk_size = min(chunk_size, self.chunk_size)
+
+        source = self.source
+        if isinstance(source, str):
+            source = np.memmap(source, dtype=self.dtype, mode='r', shape=self.shape, offset=self.offset)
+
+        if isinstance(source, np.ndarray):
+            chunks = self._array_chunks(source, chunk_size)
+        else:
+            chunks = self._iter_chunks(source, chunk_size)
+
+        sent = 0
+        total = self.nbytes
+        for chunk in chunks:
+            yield chunk
+            sent += len(chunk)
+            if self.progress is not None:
+                self.progress(sent, total)
+
+    def _array_chunks(self, array, chunk_size):
+        if array.ndim > 0 and array.flags.c_contiguous:
+            # Slices of a memmap are only read from disk as they're sent
+            flat = array.reshape(-1).view(np.uint8)
+            for offset in range(0, len(flat), chunk_size):
+                yield flat[offset:offset + chunk_size]
+            return
+
+        array = np.atleast_1d(array)
+        row_bytes = max(1, array[:1].nbytes)
+        rows = max(1, chunk_size // row_bytes)
+        for r in range(0, len(array), rows):
+            block = np.ascontiguousarray(array[r:r + rows]).reshape(-1).view(np.uint8)
+            for offset in range(0, len(block), chunk_size):
+                yield block[offset:offset + chunk_size]
+
+    def _iter_chunks(self, source, chunk_size):
+        rows = 0
+        inner = ()
+        for chunk in source:
+            if isinstance(chunk, (bytes, bytearray, memoryview)):
+                chunk = np.frombuffer(chunk, dtype=self.dtype or np.uint8)
+            else:
+                chunk = np.ascontiguousarray(chunk, dtype=self.dtype)
+            if self.dtype is None:
+                self.dtype = chunk.dtype
+            chunk = np.atleast_1d(chunk)
+            rows += len(chunk)
+            inner = chunk.shape[1:]
+
+            block = chunk.reshape(-1).view(np.uint8)
+            for offset in range(0, len(block), chunk_size):
+                yield block[offset:offset + chunk_size]
+
+        if self.dtype is None:
+            self.dtype = np.dtype(np.float64)
+        self.shape = (rows,) + inner
+
+
+def message_groups(msg, binary_data, chunk_size=_chunk_size):
+    '''
+    Generate the multipart messages for `msg`, as lists of frames.
+
+    Binary frames larger than `chunk_size`, and all Streams, are sent ahead of
+    the message as "Chunk" messages. The message's header for that frame in
+    `binary` gets a `chunks` entry describing the stream to reassemble it
+    from, and its own data frame is left empty.
+
+    The message is JSON encoded straight away, so values that can't be
+    encoded raise here rather than while it's being sent. Only its `binary`
+    headers are encoded last, once its Streams have been read, since their
+    shape may not be known before then.
+    '''
+    body = dict(msg)
+    del body['binary']
+    # Strip the closing brace so the binary headers can be appended
+    head = jsonapi.dumps(body)[:-1]
+    return _groups(msg, head, binary_data, chunk_size)
+
+
+def _groups(msg, head, binary_data, chunk_size):
+    chunked = []
+    frames = []
+    for header, data in zip(msg['binary'], binary_data):
+        if isinstance(data, Stream):
+            chunked.append((header, data.chunks(chunk_size)))
+            frames.append(b'')
+            continue
+
+        view = memoryview(data).cast('B')
+        if len(view) > chunk_size:
+            pieces = (view[offset:offset + chunk_size] for offset in range(0, len(view), chunk_size))
+            chunked.append((header, pieces))
+            frames.append(b'')
+        else:
+            frames.append(data)
+
+    for header, pieces in chunked:
+        stream = next(_stream_ids)
+        offset = 0
+        index = 0
+        for chunk in pieces:
+            size = len(chunk)
+            chunk_header = dict(stream=stream, index=index, offset=offset, size=size)
+            chunk_msg = dict(command="Chunk", target=msg['target'], args=[], id=-1,
+                             session=msg['session'], binary=[chunk_header])
+            yield [b"Nutmeg", jsonapi.dumps(chunk_msg), chunk, b'']
+            offset += size
+            index += 1
+
+        header['chunks'] = dict(stream=stream, count=index, size=offset)
+
+    for header, data in zip(msg['binary'], binary_data):
+        if isinstance(data, Stream):
+            header.update(data.header())
+
+    body = head + b', "binary": ' + jsonapi.dumps(msg['binary']) + b'}'
+    yield [b"Nutmeg", body] + frames + [b'']
+
+
+class LaneSender(object):
+    '''
+    Send outgoing messages from a background thread, always picking from the
+    highest priority lane that has messages waiting.
+
+    Binary frames larger than `chunk_size` are split into "Chunk" messages,
+    one chunk per turn of the send loop, so that small messages are
+    interleaved between the chunks of a large one rather than queueing behind
+    it. The chunks of a frame are sent before the message that uses it. That
+    frame's header in `binary` gets a `chunks` entry describing the stream to
+    reassemble it from, and its own data frame is left empty:
+    ```
+    {"type": "uint8", "shape": [320, 640, 3], "chunks": {"stream": 4, "count": 3, "size": 614400}}
+    ```
+    Each "Chunk" message carries one data frame with the header:
+    ```
+    {"stream": 4, "index": 0, "offset": 0, "size": 262144}
+    ```
+
+    Messages to a figure which already has a message waiting in a lower
+    priority lane join that lane, so messages within a figure are never
+    reordered, e.g. an Invoke never overtakes the property it works on. Only
+    messages for other figures can overtake.
+    '''
+    def __init__(self, send, chunk_size=_chunk_size, failed=None):
+        '''
+        :param send: Callable which sends a list of frames as one multipart message.
+        :param chunk_size: Binary frames larger than this, in bytes, are chunked.
+        :param failed: Called with a message which is dropped because it couldn't be sent.
+        '''
+        self.send = send
+        self.chunk_size = chunk_size
+        self.failed = failed
+
+        self.lanes = [deque(), deque(), deque()]
+        self.waiting = {}  # figure -> [lane, count]
+        self.cond = threading.Condition()
+
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, msg, binary_data):
+        '''
+        Queue a message with its binary frames. Any Streams among them are
+        only read as they're sent.
+        '''
+        binary_data = [ self._own(data) for data in binary_data ]
+
+        lane = classify(msg, binary_data, self.chunk_size)
+        # Order is kept per figure, the first component of the target
+        target = msg.get('target', '').split('.', 1)[0]
+        groups = self._groups(msg, binary_data)
+
+        with self.cond:
+            if target in self.waiting:
+                waiting = self.waiting[target]
+                lane = max(lane, waiting[0])
+                waiting[0] = lane
+                waiting[1] += 1
+            else:
+                self.waiting[target] = [lane, 1]
+
+            self.lanes[lane].append((target, groups, msg))
+            self.cond.notify()
+
+    def _own(self, data):
+        if isinstance(data, np.memmap):
+            if data.nbytes > self.chunk_size:
+                # Read from disk a chunk at a time as it's sent
+                return Stream(data)
+            return data.tobytes()
+        if isinstance(data, memoryview):
+            # May be a view of the caller's array, so take a copy before the
+            # caller can change it
+            return bytes(data)
+        return data
+
+    def _groups(self, msg, binary_data):
+        return message_groups(msg, binary_data, self.chunk_size)
+
+    def _run(self):
+        while self.running:
+            with self.cond:
+                while self.running and not any(self.lanes):
+                    self.cond.wait()
+                if not self.running:
+                    break
+
+                for lane, jobs in enumerate(self.lanes):
+                    if jobs:
+                        break
+                # Only this thread removes jobs, so it's safe to leave it at the front
+                target, groups, msg = jobs[0]
+
+            try:
+                frames = next(groups, None)
+                if frames is not None:
+                    self.send(frames)
+                    continue
+
+            except Exception:
+                # The rest of the message can't be used, so drop it
+                print("Error sending message to Nutmeg")
+                traceback.print_exc()
+                if self.failed is not None:
+                    self.failed(msg)
+
+            with self.cond:
+                jobs.popleft()
+                waiting = self.waiting[target]
+                waiting[1] -= 1
+                if waiting[1] == 0:
+                    del self.waiting[target]
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
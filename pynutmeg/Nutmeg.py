@@ -4,6 +4,7 @@ import numpy as np
 
 import os
 import sys
+import json
 
 # from . import ParallelNutmeg as Parallel
 import threading
@@ -15,34 +16,60 @@ from collections import OrderedDict
 import signal
 
 import uuid
+import string
+import traceback
+
+from zmq.utils import jsonapi
+
+from . import Lanes
+from . import Columnar
+from .Columnar import Packed
+from .Lanes import Stream
+from .State import StateStore
 
 
 _nutmegCore = None
+_nutmegCorePid = None
+_workerCore = None
 _original_sigint = None
 _address = "tcp://localhost"
 _pubport = 43686
 _subport = _pubport + 1
 _timeout = 2000
 _sync = False
+_window = None
+_lanes = False
+# Binary frames at least this big (bytes) are sent without being copied
+_zero_copy_size = 1 << 16
 
 # TODO: Handle ipc://...
 
 
-def init(address=_address, pub_port=_pubport, sub_port=_subport, timeout=_timeout, sync=_sync, force=False):
-    _core(address, pub_port, sub_port, timeout, sync, force)
+def init(address=_address, pub_port=_pubport, sub_port=_subport, timeout=_timeout, sync=_sync, force=False, window=_window):
+    _core(address, pub_port, sub_port, timeout, sync, force, window)
+
+
+def _core(address=_address, pub_port=_pubport, sub_port=_subport, timeout=_timeout, sync=_sync, force=False, window=_window):
+    global _nutmegCore, _nutmegCorePid
 
+    if _workerCore is not None:
+        # In a worker process, everything goes through the parent
+        return _workerCore
 
-def _core(address=_address, pub_port=_pubport, sub_port=_subport, timeout=_timeout, sync=_sync, force=False):
-    global _nutmegCore
+    if _nutmegCore is not None and _nutmegCorePid != os.getpid():
+        # Inherited through a fork. Its sockets and threads belong to the parent.
+        _nutmegCore = None
 
     if _nutmegCore is None or force:
-        _nutmegCore = Nutmeg(address, pub_port, sub_port, timeout, sync)
+        _nutmegCore = Nutmeg(address, pub_port, sub_port, timeout, sync, window=window)
+        _nutmegCorePid = os.getpid()
 
     elif address != _address or \
             pub_port != _pubport or \
             sub_port != _subport or \
             timeout != _timeout or \
-            sync != _sync:
+            sync != _sync or \
+            window != _window:
         print("WARNING: Module's Nutmeg core already exists with different settings. For multiple instances, manually instantiate a Nutmeg.Nutmeg(...) object.")
 
     return _nutmegCore
@@ -52,10 +79,23 @@ def initialized():
     return _nutmegCore is not None and _nutmegCore.initialized
 
 
+def _set_worker_core(core):
+    '''
+    Make the module level functions in this process use `core`, e.g. a
+    ParallelNutmeg.WorkerNutmeg, instead of their own Nutmeg.
+    '''
+    global _workerCore
+    _workerCore = core
+
+
 def figure(handle, figureDef):
     return _core().figure(handle, figureDef)
 
 
+def figure_template(name, figureDef):
+    return _core().figure_template(name, figureDef)
+
+
 def check_errors():
     _core().check_errors()
 
@@ -83,10 +123,32 @@ def to_nutmeg_message(value):
 
 def _to_nut(value, binary, binary_data):
     ''' Helper method for to_nutmeg_message '''
-    if isinstance(value, np.ndarray):
+    if isinstance(value, np.ndarray) and value.dtype.names is not None:
+        # Structured arrays are sent whole, with the fields described in the header
+        value = Packed(value)
+
+    if isinstance(value, Stream):
+        label = "$bin{:d}$".format(len(binary))
+        binary.append(value.header())
+        binary_data.append(value)
+        return label
+
+    elif isinstance(value, Packed):
+        label = "$bin{:d}$".format(len(binary))
+        binary.append(value.header())
+        binary_data.append(value.buffer())
+        return label
+
+    elif isinstance(value, np.ndarray):
         # Check if the array needs binarizing
         if value.dtype == 'O':  # Check not object type
             return _to_nut( value.tolist(), binary, binary_data )
+        elif isinstance(value, np.memmap) and value.flags.c_contiguous:
+            # Left as it is, so the lanes can read large ones from disk a chunk at a time
+            label = "$bin{:d}$".format(len(binary))
+            binary.append(dict(type=str(value.dtype), shape=value.shape))
+            binary_data.append(value)
+            return label
         else:
             header, data = ndarray_to_message(value)
             label = "$bin{:d}$".format(len(binary))
@@ -94,7 +156,7 @@ def _to_nut(value, binary, binary_data):
             binary_data.append(data)
             return label
 
-    elif isinstance(value, list):
+    elif isinstance(value, (list, tuple)):
         new_value = [_to_nut(sub_value, binary, binary_data) for sub_value in value]
         return new_value
 
@@ -102,14 +164,54 @@ def _to_nut(value, binary, binary_data):
         new_value = { key: _to_nut(sub_value, binary, binary_data) for key, sub_value in value.items() }
         return new_value
 
+    elif Columnar.is_columnar(value):
+        return _columnar_to_nut(value, binary, binary_data)
+
     else:
         return value
 
 
+def _columnar_to_nut(value, binary, binary_data):
+    '''
+    Tables become a dict of their columns. Numeric columns are sent straight
+    from their underlying buffer, without copying it to bytes first.
+    '''
+    table = Columnar.columns(value)
+    if table is not None:
+        return _to_nut(table, binary, binary_data)
+
+    array = Columnar.to_array(value)
+    if isinstance(array, np.ndarray) and array.dtype != 'O' and array.dtype.names is None:
+        array = np.ascontiguousarray(array)
+        label = "$bin{:d}$".format(len(binary))
+        binary.append(dict(type=str(array.dtype), shape=array.shape))
+        binary_data.append(memoryview(array.reshape(-1).view(np.uint8)))
+        return label
+
+    return _to_nut(array, binary, binary_data)
+
+
 class QMLException(Exception):
     pass
 
 
+def _read_qml(figureDef):
+    # We're going by the interesting assumption that a file path cannot be
+    # used to define a QML layout...
+    qml = ""
+
+    if figureDef.endswith('.qml') or os.path.exists(figureDef):
+        if os.path.exists(figureDef):
+            with open(figureDef, 'r') as F:
+                qml = F.read()  #.encode('UTF-8')
+        else:
+            raise(QMLException("File, %s, does not exist." % figureDef))
+    else:
+        qml = figureDef
+
+    return qml
+
+
 class NutmegError(Exception):
     def __init__(self, name, message, **kwargs):
         self.name = name
@@ -135,9 +237,16 @@ def _threaded(fn):
 
 class Nutmeg:
 
-    def __init__(self, address=_address, pub_port=_pubport, sub_port=_subport, timeout=_timeout, sync=_sync, pingperiod=10000):
+    def __init__(self, address=_address, pub_port=_pubport, sub_port=_subport, timeout=_timeout, sync=_sync, pingperiod=10000, window=_window, adaptive=False, lanes=_lanes, chunk_size=Lanes._chunk_size, state_memory=None, snapshot=None, spill=True):
         '''
         :param timeout: Timeout in ms
+        :param window: If set, allow up to this many unacknowledged messages in flight, blocking only when the window is full. Replaces the per-message wait of `sync`.
+        :param adaptive: Adapt the size of `window` to the measured acknowledgement latency.
+        :param lanes: Send messages from a background thread in priority lanes, so small messages aren't held up behind large binary ones.
+        :param chunk_size: With `lanes`, binary frames larger than this (bytes) are sent in chunks interleaved with higher priority messages, and np.memmap arrays larger than this are read from disk as they're sent.
+        :param state_memory: Budget in bytes for arrays kept in the replay state. None for no limit.
+        :param snapshot: How arrays are kept in the replay state: None keeps references, 'copy' copies them when set, 'cow' copies only writeable arrays.
+        :param spill: If True, arrays over `state_memory` are spilled to a scratch file, otherwise their targets are evicted from the replay state.
         '''
         self.initialized = False
         self.host = address
@@ -147,6 +256,9 @@ class Nutmeg:
         self.sub_address = address + ":" + str(sub_port)
         self.timeout = timeout
         self.sync = sync
+        self.window = None
+        if window:
+            self.window = TaskWindow(window, adaptive=adaptive, timeout=timeout/1000)
 
         self.task_count = 0
         self.session = uuid.uuid1()
@@ -165,14 +277,21 @@ class Nutmeg:
         self.socket_lock = threading.Lock()
         self.state_lock = threading.Lock()
 
+        self.chunk_size = chunk_size
+        self.sender = None
+        if lanes:
+            self.sender = Lanes.LaneSender(self._send_frames, chunk_size, self._lane_failed)
+
         self.figures = {}
         self.parameters = {}
 
         self.tasks = {}
-        self.state = OrderedDict()
+        self.state = StateStore(state_memory, snapshot=snapshot, spill=spill)
+        self.state_callbacks = []
         self.error_queue = queue.Queue()
         self.state_requested = False
         self.first_good_task = -1
+        self.sub_thread = None
 
         # Fire it up
         self.reset_socket()
@@ -215,6 +334,7 @@ class Nutmeg:
 
     @_threaded
     def _subscribe(self):
+        self.sub_thread = threading.current_thread()
         while True:
             if self.subsock is None:
                 self.subsock = self.context.socket(zmq.SUB)
@@ -255,6 +375,8 @@ class Nutmeg:
                     self.first_good_task = self.task_count
                     self.state_requested = True
                     self.send_state()
+                    if self.state_callbacks:
+                        self._state_sent()
 
                 elif mtype == 'success':
                     self._task_done(msg['id'])
@@ -266,6 +388,7 @@ class Nutmeg:
                         print("Gui:", guitarget)
                         if guitarget in self.state:
                             self.publish_message(self.state[guitarget])
+                        self._task_done(msg['id'])
                         # if self.state_requested:
                         #     self.send_state()
                     # if self.state_requested and msg['id'] >= self.first_good_task:
@@ -279,6 +402,16 @@ class Nutmeg:
                 self.subsock = None
                 self.reset_sub = False
 
+    @_threaded
+    def _state_sent(self):
+        # Off the subscriber thread, since callbacks may wait on acks
+        for callback in list(self.state_callbacks):
+            try:
+                callback()
+            except Exception:
+                print("WARNING: State callback failed")
+                traceback.print_exc()
+
     def check_errors(self):
         errors = []
         while not self.error_queue.empty():
@@ -295,16 +428,43 @@ class Nutmeg:
         except KeyError:
             pass
 
+        if self.window is not None:
+            self.window.release(task_id)
+
+    def _lane_failed(self, msg):
+        ''' Called by the lane sender when it drops a message it couldn't send. '''
+        task = self.tasks.get(msg['id'])
+        if task is not None:
+            self._task_failed(task, True)
+
+    def _task_failed(self, task, windowed):
+        '''
+        Forget a task that couldn't be sent, and give back its place in the
+        window so later messages aren't held up waiting for it to time out.
+        '''
+        if task is None:
+            # Failed before the task was created, so only the reservation is held
+            if windowed:
+                self.window.cancel()
+            return
+
+        self.tasks.pop(task.task_id, None)
+        task.done.set()
+        if self.window is not None:
+            self.window.cancel(task.task_id)
+
     def update_state(self, msg, target=None):
         self.state_lock.acquire()
 
         try:
             if target is None:
                 target = msg['target']
-            if target in self.state:
-                del self.state[target]
-
-            self.state[target] = msg
+            if any(isinstance(arg, Stream) and not arg.replayable for arg in msg['args']):
+                # One-shot streams can't be read again to replay, and neither
+                # should whatever they replaced
+                self.state.remove(target)
+            else:
+                self.state.update(target, msg)
 
         finally:
             self.state_lock.release()
@@ -320,7 +480,8 @@ class Nutmeg:
         msg = dict(command="SetParam", target=target, args=[msg['value']])
         self.update_state(msg)
 
-    def _publish(self, msg, binary_data):
+    def _publish(self, msg, binary_data, windowed=False):
+        task = None
         # Check socketlock
         self.socket_lock.acquire()
         try:
@@ -329,28 +490,74 @@ class Nutmeg:
             self.tasks[self.task_count] = task
             msg['id'] = self.task_count
             self.task_count += 1
+            if windowed:
+                self.window.sent(task.task_id)
+
+            if self.sender is not None:
+                # Queued while the lock is held, so task IDs stay in order within each lane
+                self.sender.put(msg, binary_data)
+                return task
+
+            elif not any(isinstance(data, Stream) for data in binary_data):
+                # Encode first so a bad value can't leave a half sent message
+                body = jsonapi.dumps(msg)
+                # Makes code nicer just simply having a "null message" at the end
+                self._send_multipart([b"Nutmeg", body] + binary_data + [b''])
 
-            # Send message
-            # print("Sending:", "Nutmeg")
-            self.pubsock.send(b"Nutmeg", flags=zmq.SNDMORE)
-            # print("Sending:", msg)
-            self.pubsock.send_json(msg, flags=zmq.SNDMORE)
-            # Then data
-            for data in binary_data:
-                # print("Sending binary")
-                self.pubsock.send(data, flags=zmq.SNDMORE, copy=True)
+                return task
 
-            # Makes code nicer just simply having a "null message"
-            self.pubsock.send(b'')
+        except Exception:
+            self._task_failed(task, windowed)
+            raise
+
+        finally:
+            self.socket_lock.release()
 
+        # Streams are read and sent a chunk at a time, releasing the lock in between
+        try:
+            for frames in Lanes.message_groups(msg, binary_data, self.chunk_size):
+                self._send_frames(frames)
             return task
 
-        except IOError:
+        except Exception:
+            self._task_failed(task, windowed)
             raise
 
+    def _send_frames(self, frames):
+        '''
+        Send a list of frames as a single multipart message. Used by the lane
+        sender and for streams.
+        '''
+        self.socket_lock.acquire()
+        try:
+            self._send_multipart(frames)
         finally:
             self.socket_lock.release()
 
+    def _send_multipart(self, frames):
+        '''
+        Send frames as one multipart message, with the socket lock held.
+
+        Frames of at least _zero_copy_size bytes are handed to ZMQ without
+        being copied. Those which may be views of the caller's arrays are
+        tracked until ZMQ is done with them, so the arrays can be changed as
+        soon as this returns.
+        '''
+        trackers = []
+        last = len(frames) - 1
+        for i, data in enumerate(frames):
+            flags = 0 if i == last else zmq.SNDMORE
+            if isinstance(data, bytes):
+                # Immutable, so safe to hand over
+                self.pubsock.send(data, flags=flags, copy=len(data) < _zero_copy_size)
+            elif Lanes.nbytes(data) < _zero_copy_size:
+                self.pubsock.send(data, flags=flags, copy=True)
+            else:
+                trackers.append(self.pubsock.send(data, flags=flags, copy=False, track=True))
+
+        for tracker in trackers:
+            tracker.wait()
+
     def publish_message(self, msg):
         '''
         Process the message for numpy arrays and convert them to Nutmeg-ready
@@ -366,11 +573,78 @@ class Nutmeg:
         msg['binary'] = binary_header
         msg['session'] = self.session_str
 
-        return self._publish(msg, binary_data)
+        windowed = self._acquire_window(msg['command'])
+        return self._publish(msg, binary_data, windowed)
 
-    def ping(self, sync=None):
+    def _acquire_window(self, command):
+        '''
+        Reserve a place in the window if there is one. Return whether the
+        message is windowed.
+        '''
+        # Pings and replies from the subscriber thread must never block on
+        # the window, since that thread is the one that receives the acks.
+        windowed = self.window is not None and command != 'Ping' and \
+            threading.current_thread() is not self.sub_thread
+        if windowed:
+            self.window.acquire()
+            try:
+                self.check_errors()
+            except NutmegException:
+                self.window.cancel()
+                raise
+        return windowed
+
+    def _publish_encoded(self, encode, binary_data, command):
+        '''
+        Send a message whose JSON header has already been encoded, skipping
+        the generic message conversion. Used by BoundProperty.
+        :param encode: Callable which is given the task ID and returns the JSON header as bytes.
+        '''
+        windowed = self._acquire_window(command)
+
+        task = None
+        self.socket_lock.acquire()
+        try:
+            task = Task(self, self.task_count)
+            self.tasks[self.task_count] = task
+            self.task_count += 1
+            if windowed:
+                self.window.sent(task.task_id)
+
+            body = encode(task.task_id)
+            self._send_multipart([b"Nutmeg", body] + binary_data + [b''])
+
+            return task
+
+        except Exception:
+            self._task_failed(task, windowed)
+            raise
+
+        finally:
+            self.socket_lock.release()
+
+    def _default_sync(self, sync=None):
+        '''
+        Resolve whether a call should wait for its acknowledgement. When a
+        window is in use, calls don't wait by default since the window already
+        provides flow control.
+        '''
         if sync is None:
-            sync = self.sync
+            return self.sync and self.window is None
+        return sync
+
+    def flush(self, timeout=None):
+        '''
+        Wait for all messages in the window to be acknowledged and raise any
+        errors reported by Nutmeg.
+        :param timeout: Max time to wait in seconds, default waits forever.
+        '''
+        if self.window is not None:
+            self.window.drain(timeout)
+        self.check_errors()
+
+    def ping(self, sync=None):
+        sync = self._default_sync(sync)
 
         msg = dict(command="Ping", target="", args=[])
         task = self.publish_message(msg)
@@ -379,18 +653,7 @@ class Nutmeg:
             task.wait()
 
     def figure(self, handle, figureDef):
-        # We're going by the interesting assumption that a file path cannot be
-        # used to define a QML layout...
-        qml = ""
-
-        if figureDef.endswith('.qml') or os.path.exists(figureDef):
-            if os.path.exists(figureDef):
-                with open(figureDef, 'r') as F:
-                    qml = F.read()  #.encode('UTF-8')
-            else:
-                raise(QMLException("File, %s, does not exist." % figureDef))
-        else:
-            qml = figureDef
+        qml = _read_qml(figureDef)
 
         msg = dict(command="SetFigure", target=handle, args=[qml])
         self.update_state(msg)
@@ -398,12 +661,63 @@ class Nutmeg:
 
         fig = Figure(self, handle, address=self.host, pub_port=self.pub_port, qml=qml)
 
-        if self.sync:
+        if self._default_sync():
             task.wait()
             self.check_errors()
 
         return fig
 
+    def figure_template(self, name, figureDef, expand=False):
+        '''
+        Register a QML definition once, to create many figures from.
+        Placeholders in the QML are written as `${key}`.
+
+        :param name: Name of the template
+        :param figureDef: QML definition, or path to a .qml file
+        :param expand: If True, the template is filled in here and each figure sent with its own SetFigure, for viewers without template support.
+        :return: FigureTemplate
+        '''
+        qml = _read_qml(figureDef)
+
+        if not expand:
+            msg = dict(command="SetTemplate", target=name, args=[qml])
+            self.update_state(msg, target='{}.TEMPLATE'.format(name))
+            task = self.publish_message(msg)
+
+            if self._default_sync():
+                task.wait()
+                self.check_errors()
+
+        return FigureTemplate(self, name, qml, expand)
+
+    def figures_from_template(self, name, instances, qml=None):
+        '''
+        Create many figures from a registered template in a single batched
+        command, which is also kept as a single entry in the state.
+
+        :param name: Name of the template
+        :param instances: List of (handle, substitutions) pairs
+        :param qml: The template's QML, to fill in each Figure's `qml`
+        :return: List of Figures, in the order of `instances`
+        '''
+        handles = [ handle for handle, _ in instances ]
+        batch = [ dict(handle=handle, substitutions=subs) for handle, subs in instances ]
+
+        msg = dict(command="SetFigures", target=name, args=[batch])
+        self.update_state(msg, target='{}.INSTANCES({})'.format(name, ','.join(handles)))
+        task = self.publish_message(msg)
+
+        figs = []
+        for handle, subs in instances:
+            fig_qml = None if qml is None else string.Template(qml).safe_substitute(subs)
+            figs.append( Figure(self, handle, address=self.host, pub_port=self.pub_port, qml=fig_qml) )
+
+        if self._default_sync():
+            task.wait()
+            self.check_errors()
+
+        return figs
+
     def set_gui(self, handle, qml):
         '''
         Set the Gui definition of the Figure with handle, `handle`.
@@ -414,7 +728,7 @@ class Nutmeg:
         self.update_state(msg, target='{}.GUI'.format(handle))
         task = self.publish_message(msg)
 
-        if self.sync:
+        if self._default_sync():
             task.wait()
             self.check_errors()
 
@@ -422,8 +736,7 @@ class Nutmeg:
         '''
         Set property at handle
         '''
-        if sync is None:
-            sync = self.sync
+        sync = self._default_sync(sync)
 
         msg = dict(command="SetProperty", target=handle, args=[value])
         self.update_state(msg)
@@ -439,16 +752,47 @@ class Nutmeg:
         for name, value in properties.items():
             tasks.append( self.set_property('.'.join((handle, name)), value, False) )
 
-        if self.sync:
+        if self._default_sync():
             for task in tasks:
                 task.wait()
             self.check_errors()
 
+    def set_series(self, handle, series=None, sync=None, **columns):
+        '''
+        Set properties of many series in one message. Each property is sent
+        as a single contiguous frame holding that property for every series.
+        See Packed for the layouts accepted.
+
+        :param handle: Handle that the series are under, e.g. 'fig.ax'
+        :param series: Handles of the series relative to `handle`, in order. If None, the field names of structured arrays are used.
+        :param **columns: Each keyword is a property of every series, e.g. y=Y
+        '''
+        sync = self._default_sync(sync)
+
+        packed = { name: value if isinstance(value, Packed) else Packed(value)
+                   for name, value in columns.items() }
+        if series is None:
+            names = [ value.names for value in packed.values() if value.names is not None ]
+            if not names:
+                raise ValueError("Series handles are needed unless structured arrays are given")
+            series = names[0]
+
+        series = list(series)
+        for name, value in packed.items():
+            if len(value) != len(series):
+                raise ValueError("{} has {} series, expected {}".format(name, len(value), len(series)))
+
+        msg = dict(command="SetSeries", target=handle, args=[series, packed])
+        self.update_state(msg, target='{}.SERIES({})'.format(handle, ','.join(series)))
+        task = self.publish_message(msg)
+
+        if sync:
+            task.wait()
+            self.check_errors()
+        return task
+
     def invoke_method(self, handle, *args, **kwargs):
-        if 'sync' in kwargs and kwargs['sync'] is not None:
-            sync = kwargs['sync']
-        else:
-            sync = self.sync
+        sync = self._default_sync(kwargs.get('sync'))
 
         msg = dict(command="Invoke", target=handle, args=args)
         task = self.publish_message(msg)
@@ -462,8 +806,7 @@ class Nutmeg:
         '''
         Set Gui property at handle
         '''
-        if sync is None:
-            sync = self.sync
+        sync = self._default_sync(sync)
 
         msg = dict(command="SetParam", target=handle, args=[value])
         self.update_state(msg)
@@ -478,11 +821,29 @@ class Nutmeg:
         for name, value in params.items():
             tasks.append( self.set_parameter('.'.join((handle, name)), value, False) )
 
-        if self.sync:
+        if self._default_sync():
             for task in tasks:
                 task.wait()
             self.check_errors()
 
+    def bind(self, handle):
+        '''
+        Return a BoundProperty for fast repeated setting of the property at `handle`.
+        '''
+        return BoundProperty(self, handle)
+
+    def register_state_callback(self, callback):
+        '''
+        Call this function whenever the viewer requests the state, after the
+        state has been sent. For resending anything that isn't kept in the
+        state, such as the results of method invokations.
+        '''
+        self.state_callbacks.append(callback)
+
+    def unregister_state_callback(self, callback):
+        if callback in self.state_callbacks:
+            self.state_callbacks.remove(callback)
+
     def parameter(self, handle, param):
         key = '.'.join((handle, param))
         if key not in self.parameters:
@@ -526,6 +887,128 @@ class Task(object):
         return self.done.wait(timeout)
 
 
+class TaskWindow(object):
+    '''
+    Flow control for published tasks. Allow up to `size` unacknowledged tasks
+    in flight, and block the publisher only once the window is full.
+
+    If `adaptive`, the window grows while the acknowledgement latency stays
+    close to the best latency seen, and shrinks once it rises, which means
+    messages are queueing up in the viewer.
+    '''
+    def __init__(self, size, adaptive=False, min_size=1, max_size=1024, timeout=2.0):
+        '''
+        :param size: Initial number of tasks allowed in flight.
+        :param timeout: Time in seconds after which an unacknowledged task is assumed lost.
+        '''
+        self.size = float(size)
+        self.adaptive = adaptive
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+
+        self.cond = threading.Condition()
+        self.sent_times = OrderedDict()
+        self.reserved = 0
+        self.latency = None
+        self.base_latency = None
+
+    def in_flight(self):
+        return len(self.sent_times) + self.reserved
+
+    def acquire(self):
+        '''
+        Reserve a slot in the window, blocking while it is full.
+        '''
+        with self.cond:
+            while self.in_flight() >= int(self.size):
+                if not self.sent_times:
+                    # Only reservations are outstanding, they'll be sent soon
+                    self.cond.wait(0.01)
+                    continue
+
+                if self._expire():
+                    continue
+                oldest = next(iter(self.sent_times.values()))
+                self.cond.wait(max(oldest + self.timeout - time.time(), 0.001))
+
+            self.reserved += 1
+
+    def cancel(self, task_id=None):
+        '''
+        Give back a reservation, or a sent task that failed.
+        '''
+        with self.cond:
+            if task_id is None:
+                self.reserved -= 1
+            else:
+                self.sent_times.pop(task_id, None)
+            self.cond.notify_all()
+
+    def sent(self, task_id):
+        with self.cond:
+            self.reserved -= 1
+            self.sent_times[task_id] = time.time()
+
+    def release(self, task_id):
+        with self.cond:
+            t_sent = self.sent_times.pop(task_id, None)
+            if t_sent is None:
+                return
+
+            if self.adaptive:
+                self._adapt(time.time() - t_sent)
+            self.cond.notify_all()
+
+    def drain(self, timeout=None):
+        '''
+        Wait until all tasks in the window are acknowledged or time out.
+        '''
+        t0 = time.time()
+        with self.cond:
+            while self.in_flight() > 0:
+                if timeout is not None and time.time() - t0 > timeout:
+                    return False
+                self._expire()
+                self.cond.wait(0.01)
+        return True
+
+    def _expire(self):
+        '''
+        Forget tasks whose acknowledgements are overdue and assumed lost.
+        Lost acks only shrink the window when it's adaptive, since a fixed
+        window has nothing to grow it back again.
+        :return: Whether any were forgotten.
+        '''
+        now = time.time()
+        expired = 0
+        while self.sent_times and next(iter(self.sent_times.values())) + self.timeout <= now:
+            self.sent_times.popitem(last=False)
+            expired += 1
+
+        if expired and self.adaptive:
+            self._resize(0.5 * self.size)
+        return expired > 0
+
+    def _adapt(self, latency):
+        if self.base_latency is None or latency < self.base_latency:
+            self.base_latency = latency
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += 0.125 * (latency - self.latency)
+
+        # Grow by about one task per window's worth of acks while the latency
+        # stays low, and shrink similarly when the viewer starts to queue.
+        if self.latency <= 2 * self.base_latency + 0.001:
+            self._resize(self.size + 1 / self.size)
+        else:
+            self._resize(self.size - 1 / self.size)
+
+    def _resize(self, size):
+        self.size = min(max(size, self.min_size), self.max_size)
+
+
 class NutmegObject(object):
     def __init__(self, handle):
         self.handle = handle
@@ -574,6 +1057,8 @@ class Figure(NutmegObject):
         ```figure.set('ax.data.x', range(10))```
         or
         ```figure.set('ax.data', x=range(10), y=someData})```
+        or with a table, such as a pandas DataFrame, whose columns are named after the properties
+        ```figure.set('ax.data', df[['x', 'y']])```
 
         :param handle: A string to the object or property of interest
         :param *value: The first value is used to set the property at `handle`. If this is empty, **properties is used
@@ -587,11 +1072,34 @@ class Figure(NutmegObject):
             if len(properties) > 0:
                 print("WARNING: Keyword arguments ignored")
 
-            self.nutmeg.set_property(full_handle, value[0])
+            table = Columnar.columns(value[0])
+            if table is not None:
+                # Each column of a table sets the property of the same name
+                self.nutmeg.set_properties(full_handle, **table)
+            else:
+                self.nutmeg.set_property(full_handle, value[0])
 
         else:
             self.nutmeg.set_properties(full_handle, **properties)
 
+    def set_series(self, handle, series=None, **columns):
+        '''
+        Set properties of many series at once, sending each property as a
+        single frame rather than one per series.
+
+        For example:
+        ```figure.set_series('ax', ['blue', 'red', 'green'], y=Y)```
+        where Y has one row per series, or with a structured array whose
+        fields are named after the series:
+        ```figure.set_series('ax', y=records)```
+
+        :param handle: A string to the object the series are under
+        :param series: Series handles relative to `handle`
+        :param **columns: Each keyword is a property to set on every series
+        '''
+        full_handle = self.handle + "." + handle
+        self.nutmeg.set_series(full_handle, series, **columns)
+
     def invoke(self, handle, *args):
         '''
         Invoke method in at the given location with args.
@@ -605,6 +1113,165 @@ class Figure(NutmegObject):
         full_handle = self.handle + "." + handle
         self.nutmeg.invoke_method(full_handle, *args)
 
+    def bind(self, handle):
+        '''
+        Bind to a single property for fast repeated setting. The target and
+        message header are worked out once, so each `set` only has to encode
+        the new value.
+
+        For example:
+        ```
+        y = figure.bind('ax.blue.y')
+        for i in range(1000):
+            y.set(data[i])
+        ```
+
+        :param handle: A string to the property of interest
+        :return: BoundProperty
+        '''
+        return self.nutmeg.bind(self.handle + "." + handle)
+
+    def schedule(self, handle, func, *params, **kwargs):
+        '''
+        Recompute `func` off the main thread whenever any of `params` change,
+        and set the freshest result at `handle`. Superseded results are never
+        published.
+
+        For example:
+        ```figure.schedule('ax.blue.y', get_y, figure.parameter('sigma'))```
+
+        If the result is a dict, it is treated as keyword properties of `handle`.
+
+        :param handle: String with "address" to set with the result.
+        :param func: Called with the current value of each parameter, in order.
+        :param *params: Parameters which trigger recomputation.
+        :param **kwargs: Passed on to ComputeScheduler (pool, workers, drop_stale, start).
+        :return: The ComputeScheduler. Call its `stop()` to unbind.
+        '''
+        from .Scheduler import ComputeScheduler
+
+        def output(result):
+            if isinstance(result, dict):
+                self.set(handle, **result)
+            else:
+                self.set(handle, result)
+
+        return ComputeScheduler(func, list(params), output, **kwargs)
+
+
+_scalar_types = (bool, int, float, str, type(None))
+_no_binary = b'], "binary": [], "id": '
+
+
+class BoundProperty(object):
+    '''
+    A property handle with a precomputed target, state entry and JSON header
+    prefix. Each `set` only encodes the changing value, or swaps the binary
+    frame for numeric arrays, before sending.
+    '''
+    def __init__(self, nutmeg, handle):
+        self.nutmeg = nutmeg
+        self.handle = handle
+        self.msg = dict(command="SetProperty", target=handle, args=[None])
+
+        head = dict(command="SetProperty", target=handle, session=nutmeg.session_str)
+        # Strip the closing brace so the remaining keys can be appended
+        self.prefix = jsonapi.dumps(head)[:-1] + b', "args": ['
+        self.array_headers = {}
+
+    def _array_header(self, array):
+        key = (array.dtype.str, array.shape)
+        header = self.array_headers.get(key)
+        if header is None:
+            binary, _ = ndarray_to_message(array)
+            header = b'"$bin0$"], "binary": ' + jsonapi.dumps([binary]) + b', "id": '
+            self.array_headers[key] = header
+        return header
+
+    def set(self, value, sync=None):
+        '''
+        Set the bound property to `value`.
+        '''
+        nutmeg = self.nutmeg
+
+        # Only the args change, so the same state entry is reused. It still
+        # moves to the end so it's replayed after a redefined figure.
+        self.msg['args'] = [value]
+        nutmeg.update_state(self.msg, self.handle)
+
+        if nutmeg.sender is not None or isinstance(value, Stream):
+            # The lanes need the message itself to classify and chunk it,
+            # and streams are sent in chunks ahead of the message
+            task = nutmeg.publish_message(dict(self.msg))
+
+        else:
+            nutmeg.check_errors()
+            if not nutmeg.state_requested:
+                task = Task(nutmeg, -1)
+                task.done.set()
+                return task
+
+            if isinstance(value, _scalar_types):
+                middle = json.dumps(value).encode() + _no_binary
+                binary_data = []
+            elif isinstance(value, np.ndarray) and value.dtype != 'O' and value.dtype.names is None:
+                middle = self._array_header(value)
+                binary_data = [value.tobytes()]
+            else:
+                new_value, binary, binary_data = to_nutmeg_message(value)
+                middle = jsonapi.dumps(new_value) + b'], "binary": ' + jsonapi.dumps(binary) + b', "id": '
+
+            head = self.prefix + middle
+            task = nutmeg._publish_encoded(lambda task_id: head + str(task_id).encode() + b'}', binary_data, "SetProperty")
+
+        if nutmeg._default_sync(sync):
+            task.wait()
+            nutmeg.check_errors()
+        return task
+
+
+class FigureTemplate(object):
+    '''
+    A QML definition registered once with Nutmeg, from which many similar
+    figures can be created in one go.
+
+    For example:
+    ```
+    template = nutmeg.figure_template('trace', 'Figure { Axis { handle: "ax"; title: "${title}" } }')
+    figs = template.figures({'trace{}'.format(i): dict(title=str(i)) for i in range(48)})
+    ```
+    '''
+    def __init__(self, nutmeg, name, qml, expand=False):
+        self.nutmeg = nutmeg
+        self.name = name
+        self.qml = qml
+        self.expand = expand
+
+    def figures(self, instances, **substitutions):
+        '''
+        Create figures from this template.
+
+        :param instances: A list of handles, or a dict of handle to substitutions for that figure.
+        :param **substitutions: Substitutions shared by every figure, which per-figure substitutions override.
+        :return: List of Figures, in the order given
+        '''
+        if isinstance(instances, dict):
+            pairs = [ (handle, dict(substitutions, **subs)) for handle, subs in instances.items() ]
+        else:
+            pairs = [ (handle, dict(substitutions)) for handle in instances ]
+
+        if self.expand:
+            template = string.Template(self.qml)
+            return [ self.nutmeg.figure(handle, template.safe_substitute(subs)) for handle, subs in pairs ]
+
+        return self.nutmeg.figures_from_template(self.name, pairs, self.qml)
+
+    def figure(self, handle, **substitutions):
+        '''
+        Create a single figure from this template.
+        '''
+        return self.figures({handle: substitutions})[0]
+
 
 class Parameter():
     '''
@@ -696,6 +1363,13 @@ class Parameter():
         '''
         self.callbacks.append(callback)
 
+    def unregister_callback(self, callback):
+        '''
+        Stop calling this function when the value is changed.
+        '''
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
 
 class Button(object):
     def __init__(self, param):
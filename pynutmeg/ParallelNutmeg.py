@@ -2,10 +2,193 @@ from __future__ import print_function, division
 import multiprocessing
 import signal
 import sys
+import threading
+import time
+import traceback
+import pickle
+import socket
+import string
+import uuid
 
+import zmq
 
-def _spawn(f):
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from collections import OrderedDict
+
+from .Nutmeg import Figure, FigureTemplate, Parameter, _core, _read_qml, _set_worker_core
+
+
+# Relayed calls which only need their latest value sent
+_coalesced = ('set_property', 'set_parameter')
+
+
+class WorkerNutmeg(object):
+    '''
+    Stand-in for a Nutmeg inside a worker process. Rather than connecting to
+    Nutmeg itself, every update is forwarded over a queue to a single WorkerRelay in
+    the parent process.
+
+    Workers started by `parallelize` or `sub_process` with a relay have one
+    installed as the module's core, so `pynutmeg.figure(...)` works as usual.
+    '''
+    def __init__(self, relay_queue):
+        self.queue = relay_queue
+        self.sync = False
+        self.initialized = True
+        self.parameters = {}
+
+    def _put(self, call, handle, *args, **kwargs):
+        self.queue.put((call, handle, args, kwargs))
+
+    def figure(self, handle, figureDef):
+        qml = _read_qml(figureDef)
+        self._put('figure', handle, qml)
+        return Figure(self, handle, address=None, pub_port=None, qml=qml)
+
+    def figure_template(self, name, figureDef, expand=False):
+        qml = _read_qml(figureDef)
+        if not expand:
+            self._put('figure_template', name, qml)
+        return FigureTemplate(self, name, qml, expand)
+
+    def figures_from_template(self, name, instances, qml=None):
+        self._put('figures_from_template', name, list(instances))
+        return [ Figure(self, handle, address=None, pub_port=None,
+                        qml=None if qml is None else string.Template(qml).safe_substitute(subs))
+                 for handle, subs in instances ]
+
+    def set_gui(self, handle, qml):
+        self._put('set_gui', handle, qml)
+
+    def set_property(self, handle, value, sync=None):
+        self._put('set_property', handle, value)
+
+    def set_properties(self, handle, **properties):
+        for name, value in properties.items():
+            self.set_property('.'.join((handle, name)), value)
+
+    def set_series(self, handle, series=None, sync=None, **columns):
+        self._put('set_series', handle, series, **columns)
+
+    def invoke_method(self, handle, *args, **kwargs):
+        self._put('invoke_method', handle, *args)
+
+    def set_parameter(self, handle, value, sync=None):
+        self._put('set_parameter', handle, value)
+
+    def set_parameters(self, handle, **params):
+        for name, value in params.items():
+            self.set_parameter('.'.join((handle, name)), value)
+
+    def parameter(self, handle, param):
+        key = '.'.join((handle, param))
+        if key not in self.parameters:
+            self.parameters[key] = Parameter(handle, param, nutmeg=self)
+        return self.parameters[key]
+
+    def bind(self, handle):
+        return _WorkerBound(self, handle)
+
+    def register_state_callback(self, callback):
+        # State requests reach the parent, which holds the state
+        pass
+
+    def unregister_state_callback(self, callback):
+        pass
+
+    def check_errors(self):
+        # Errors are raised in the parent, which is the one talking to Nutmeg
+        pass
+
+    def wait_for_nutmeg(self, timeout=10):
+        pass
+
+    def flush(self, timeout=None):
+        pass
+
+
+class _WorkerBound(object):
+    def __init__(self, nutmeg, handle):
+        self.nutmeg = nutmeg
+        self.handle = handle
+
+    def set(self, value, sync=None):
+        self.nutmeg.set_property(self.handle, value)
+
+
+class WorkerRelay(object):
+    '''
+    Receive figure updates from WorkerNutmegs and send them on through one
+    Nutmeg in this process, so workers don't each need their own connection.
+
+    Updates waiting in the queue are coalesced before being sent: only the
+    latest value for each property or parameter is kept, across all workers.
+    '''
+    def __init__(self, nutmeg=None, period=0):
+        '''
+        :param nutmeg: Nutmeg to send through. Defaults to the module's core.
+        :param period: Minimum time in seconds between batches, allowing more updates to coalesce.
+        '''
+        self.nutmeg = nutmeg if nutmeg is not None else _core()
+        self.period = period
+        self.queue = multiprocessing.Queue()
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            t0 = time.time()
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    remaining = self.period - (time.time() - t0)
+                    if remaining <= 0:
+                        break
+                    time.sleep(min(remaining, 0.005))
+
+            calls = OrderedDict()
+            for i, item in enumerate(batch):
+                if item is None:
+                    running = False
+                    continue
+                call, handle, args, kwargs = item
+                key = (call, handle) if call in _coalesced else i
+                # Latest value moves to the end, like Nutmeg.update_state
+                calls.pop(key, None)
+                calls[key] = item
+
+            for call, handle, args, kwargs in calls.values():
+                try:
+                    getattr(self.nutmeg, call)(handle, *args, **kwargs)
+                except Exception:
+                    print("Error relaying", call, "to", handle)
+                    traceback.print_exc()
+
+    def stop(self):
+        '''
+        Send everything already queued, then stop the relay.
+        '''
+        self.queue.put(None)
+        self.thread.join()
+
+
+def _worker_init(relay_queue):
+    if relay_queue is not None:
+        _set_worker_core(WorkerNutmeg(relay_queue))
+
+
+def _spawn(f, relay_queue=None):
     def fun(q_in,q_out):
+        _worker_init(relay_queue)
         while True:
             i,x = q_in.get()
             if i is None:
@@ -16,7 +199,7 @@ def _spawn(f):
 proc = []
 original_sigint = None
 
-def parallelize(func, argList, maxProcesses=multiprocessing.cpu_count()):
+def parallelize(func, argList, maxProcesses=multiprocessing.cpu_count(), relay=None):
     '''
     Parellize multiple calls to `func` with values from `argList`.
 
@@ -25,6 +208,7 @@ def parallelize(func, argList, maxProcesses=multiprocessing.cpu_count()):
     :param func: A function which takes a single argument.
     :param argList: A single dimension array-like object.
     :param maxProcesses: The maximum allowed threads. If set to -1, the maxProcesses will be set to the length of arg-list.
+    :param relay: True, or a WorkerRelay, to let `func` plot through the parent's Nutmeg with the usual `pynutmeg.figure(...)`.
 
     :return: List of return values associated with argList.
     '''
@@ -36,8 +220,13 @@ def parallelize(func, argList, maxProcesses=multiprocessing.cpu_count()):
     q_in = multiprocessing.Queue(1)
     q_out = multiprocessing.Queue()
 
+    own_relay = relay is True
+    if own_relay:
+        relay = WorkerRelay()
+    relay_queue = relay.queue if relay else None
+
     global proc
-    proc = [multiprocessing.Process(target=_spawn(func), args=(q_in,q_out))
+    proc = [multiprocessing.Process(target=_spawn(func, relay_queue), args=(q_in,q_out))
             for _ in range(maxProcesses)]
     for p in proc:
         p.daemon = True
@@ -49,8 +238,15 @@ def parallelize(func, argList, maxProcesses=multiprocessing.cpu_count()):
 
     [p.join() for p in proc]
 
+    if own_relay:
+        relay.stop()
+
     resultArray = [x for i,x in sorted(res)]
-    if type(resultArray[0]) is tuple:
+    return _unzip(resultArray)
+
+def _unzip(resultArray):
+    ''' Turn a list of tuples into a tuple of lists '''
+    if len(resultArray) > 0 and type(resultArray[0]) is tuple:
         newResult = []
         for i in range(len(resultArray[0])):
             newResult.append( [v[i] for v in resultArray] )
@@ -58,21 +254,306 @@ def parallelize(func, argList, maxProcesses=multiprocessing.cpu_count()):
 
     return resultArray
 
-def _spawn_single(f):
+def _spawn_single(f, relay_queue=None):
     def fun(x,q_out):
+        _worker_init(relay_queue)
         q_out.put(f(x))
     return fun
 
-def sub_process(func, arg):
+def sub_process(func, arg, relay=None):
     q_out = multiprocessing.Queue(1)
 
-    p = multiprocessing.Process(target=_spawn_single(func), args=(arg, q_out))
+    own_relay = relay is True
+    if own_relay:
+        relay = WorkerRelay()
+    relay_queue = relay.queue if relay else None
+
+    p = multiprocessing.Process(target=_spawn_single(func, relay_queue), args=(arg, q_out))
     p.start()
     result = q_out.get()
     p.join()
+
+    if own_relay:
+        relay.stop()
     return result
 
 
+class TaskFarmError(Exception):
+    pass
+
+
+def _work_chunk(func, args):
+    try:
+        return True, [func(x) for x in args]
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def _heartbeat(context, sink_address, identity, period, stop):
+    sock = context.socket(zmq.PUSH)
+    sock.setsockopt(zmq.LINGER, 0)
+    sock.connect(sink_address)
+    while not stop.wait(period):
+        sock.send_multipart([b'hb', identity])
+    sock.close()
+
+
+def worker(address, sink_address, prefetch=1, heartbeat=1.0):
+    '''
+    Run a TaskFarm worker until the farm tells it to stop. Tasks are pulled
+    from the ventilator at `address`, and results pushed to the sink at
+    `sink_address`. A heartbeat is sent to the sink every `heartbeat` seconds
+    so the farm can tell a busy worker from a dead one.
+
+    The function being farmed is pickled by reference, so it must be
+    importable on the worker's machine.
+
+    Start remote workers with:
+    ```python -m pynutmeg.ParallelNutmeg worker <address> <sink_address>```
+    '''
+    context = zmq.Context()
+    identity = uuid.uuid4().hex.encode()
+
+    tasks = context.socket(zmq.DEALER)
+    tasks.setsockopt(zmq.IDENTITY, identity)
+    tasks.setsockopt(zmq.LINGER, 0)
+    tasks.connect(address)
+
+    results = context.socket(zmq.PUSH)
+    results.connect(sink_address)
+
+    stop = threading.Event()
+    beat = threading.Thread(target=_heartbeat, args=(context, sink_address, identity, heartbeat, stop))
+    beat.daemon = True
+    beat.start()
+
+    # Ask for work. More is only asked for once a result is sent, so busy
+    # workers are never given more than `prefetch` tasks at a time.
+    tasks.send_multipart([b'ready', str(prefetch).encode()])
+    try:
+        while True:
+            frames = tasks.recv_multipart()
+            if frames[0] == b'stop':
+                break
+
+            chunk_id = frames[1]
+            func, args = pickle.loads(frames[2])
+            outcome = _work_chunk(func, args)
+            results.send_multipart([b'result', identity, chunk_id, pickle.dumps(outcome, pickle.HIGHEST_PROTOCOL)])
+            tasks.send_multipart([b'ready', b'1'])
+
+    finally:
+        stop.set()
+        beat.join()
+        results.close()
+        tasks.close()
+        context.term()
+
+
+def _reachable(endpoint, host):
+    '''
+    Replace the wildcard interface of a bound tcp:// endpoint with `host`.
+    '''
+    prefix, port = endpoint.rsplit(':', 1)
+    if prefix in ('tcp://0.0.0.0', 'tcp://[::]'):
+        return 'tcp://{}:{}'.format(host, port)
+    return endpoint
+
+
+class TaskFarm(object):
+    '''
+    Farm chunks of work out over ZMQ to worker processes, which may be on
+    other machines.
+
+    The ventilator is a ROUTER socket that workers ask for work from. Each
+    worker only asks for more once it has finished what it has, so work is
+    dispatched according to load. Results are pushed back to the sink, a
+    PULL socket, and put back in order of `argList`. If a worker isn't heard
+    from for `timeout` seconds, the chunks it was given are resubmitted to
+    the other workers.
+    '''
+    def __init__(self, address='tcp://127.0.0.1:*', sink_address=None, timeout=10.0, host=None):
+        '''
+        :param address: Address to bind the ventilator to. With a '*' port, a free port is picked.
+        :param sink_address: Address to bind the sink to. Defaults to the next free port of the same host, or '<address>.sink' for ipc://.
+        :param timeout: Seconds without hearing from a worker before it is considered lost.
+        :param host: Name or IP that remote workers reach this machine by, used in `address` and `sink_address` when binding to all interfaces ('*'). Defaults to this machine's fully qualified name.
+        '''
+        self.timeout = timeout
+        self.context = zmq.Context()
+        if host is None:
+            host = socket.getfqdn()
+
+        self.ventilator = self.context.socket(zmq.ROUTER)
+        self.ventilator.setsockopt(zmq.LINGER, 0)
+        self.ventilator.bind(address)
+        endpoint = self.ventilator.getsockopt(zmq.LAST_ENDPOINT).decode()
+        # Where workers on other machines connect to, and local ones
+        self.address = _reachable(endpoint, host)
+        self.local_address = _reachable(endpoint, '127.0.0.1')
+
+        if sink_address is None:
+            if address.startswith('ipc://'):
+                sink_address = address + '.sink'
+            else:
+                sink_address = address.rsplit(':', 1)[0] + ':*'
+        self.sink = self.context.socket(zmq.PULL)
+        self.sink.setsockopt(zmq.LINGER, 0)
+        self.sink.bind(sink_address)
+        endpoint = self.sink.getsockopt(zmq.LAST_ENDPOINT).decode()
+        self.sink_address = _reachable(endpoint, host)
+        self.local_sink_address = _reachable(endpoint, '127.0.0.1')
+        self.remote = self.address != self.local_address
+
+        self.workers = {}  # identity -> [last seen, credit, set of chunk ids]
+
+    def start_workers(self, count):
+        '''
+        Start `count` local worker processes.
+        '''
+        procs = [multiprocessing.Process(target=worker, args=(self.local_address, self.local_sink_address))
+                 for _ in range(count)]
+        for p in procs:
+            p.daemon = True
+            p.start()
+        return procs
+
+    def map(self, func, argList, chunksize=1, procs=None):
+        '''
+        Call `func` on every value in `argList` using the connected workers.
+        :param procs: Local worker processes. If they all die with work left, an error is raised rather than waiting for remote workers.
+        :return: List of return values in the order of `argList`.
+        '''
+        args = list(argList)
+        chunks = [args[i:i + chunksize] for i in range(0, len(args), chunksize)]
+        pending = list(range(len(chunks)))[::-1]  # Popped from the end
+        results = [None] * len(chunks)
+        done = 0
+
+        poller = zmq.Poller()
+        poller.register(self.ventilator, zmq.POLLIN)
+        poller.register(self.sink, zmq.POLLIN)
+
+        while done < len(chunks):
+            for sock, _ in poller.poll(100):
+                if sock is self.ventilator:
+                    identity, kind, credit = self.ventilator.recv_multipart()
+                    state = self._seen(identity)
+                    state[1] += int(credit)
+
+                else:
+                    frames = self.sink.recv_multipart()
+                    state = self._seen(frames[1])
+                    if frames[0] != b'result':
+                        continue
+
+                    chunk_id = int(frames[2])
+                    state[2].discard(chunk_id)
+                    # A resubmitted chunk may be finished twice, the first one wins
+                    if results[chunk_id] is None:
+                        ok, outcome = pickle.loads(frames[3])
+                        if not ok:
+                            self.stop()
+                            raise TaskFarmError("Task failed on worker:\n" + outcome)
+                        results[chunk_id] = outcome
+                        done += 1
+
+            self._reap(pending)
+            self._dispatch(func, chunks, pending, results)
+
+            if procs and not any(p.is_alive() for p in procs) and done < len(chunks):
+                self.stop()
+                raise TaskFarmError("All local workers died with work remaining")
+
+        return [x for chunk in results for x in chunk]
+
+    def _seen(self, identity):
+        if identity not in self.workers:
+            self.workers[identity] = [0, 0, set()]
+        state = self.workers[identity]
+        state[0] = time.time()
+        return state
+
+    def _reap(self, pending):
+        ''' Resubmit the work of workers that haven't been heard from. '''
+        now = time.time()
+        for identity, state in list(self.workers.items()):
+            if now - state[0] > self.timeout:
+                print("Lost worker, resubmitting {} chunks".format(len(state[2])))
+                pending.extend(state[2])
+                del self.workers[identity]
+
+    def _dispatch(self, func, chunks, pending, results):
+        for identity, state in self.workers.items():
+            while state[1] > 0 and pending:
+                chunk_id = pending.pop()
+                if results[chunk_id] is not None:
+                    continue
+                payload = pickle.dumps((func, chunks[chunk_id]), pickle.HIGHEST_PROTOCOL)
+                self.ventilator.send_multipart([identity, b'task', str(chunk_id).encode(), payload])
+                state[1] -= 1
+                state[2].add(chunk_id)
+
+    def stop(self):
+        '''
+        Tell the known workers to exit and close the sockets.
+        '''
+        if self.ventilator.closed:
+            return
+        for identity in self.workers:
+            self.ventilator.send_multipart([identity, b'stop'])
+        self.workers = {}
+        # Give the stop messages a moment to go out before closing
+        self.ventilator.setsockopt(zmq.LINGER, 1000)
+        self.ventilator.close()
+        self.sink.close()
+        self.context.term()
+
+
+def distribute(func, argList, workers=multiprocessing.cpu_count(), address='tcp://127.0.0.1:*',
+               sink_address=None, chunksize=1, timeout=10.0, host=None):
+    '''
+    Like `parallelize`, but the work is farmed out over ZMQ, so workers on
+    other machines can join in. See TaskFarm.
+
+    :param func: A module level function which takes a single argument.
+    :param argList: A single dimension array-like object.
+    :param workers: Number of local worker processes to start. Use 0 to only use workers started elsewhere with `python -m pynutmeg.ParallelNutmeg worker <address> <sink_address>`.
+    :param address: Address for the ventilator, e.g. 'tcp://*:5557' to accept remote workers, or 'ipc:///tmp/farm'.
+    :param chunksize: Number of values from argList sent to a worker at a time.
+    :param timeout: Seconds without hearing from a worker before its work is resubmitted.
+    :param host: Name or IP that remote workers reach this machine by. See TaskFarm.
+
+    :return: List of return values associated with argList.
+    '''
+    global original_sigint, proc
+    original_sigint = signal.getsignal(signal.SIGINT)
+    signal.signal(signal.SIGINT, exit_gracefully)
+
+    farm = None
+    proc = []
+    try:
+        farm = TaskFarm(address, sink_address, timeout, host)
+        if workers == 0 or farm.remote:
+            print("Start workers with:\n\tpython -m pynutmeg.ParallelNutmeg worker {} {}".format(farm.address, farm.sink_address))
+
+        proc = farm.start_workers(workers)
+        results = farm.map(func, argList, chunksize, procs=proc)
+
+    finally:
+        if farm is not None:
+            farm.stop()
+
+        for p in proc:
+            p.join(1)
+            if p.is_alive():
+                p.terminate()
+
+        signal.signal(signal.SIGINT, original_sigint)
+
+    return _unzip(results)
+
+
 def exit_gracefully(signum, frame):
     # restore the original signal handler as otherwise evil things will happen
     # in raw_input when CTRL+C is pressed, and our signal handler is not re-entrant
@@ -98,4 +579,7 @@ def _quickTest():
     print(parallelize(waitTime, x, maxProcesses=8))
 
 if __name__ == '__main__':
-    _quickTest()
+    if len(sys.argv) >= 4 and sys.argv[1] == 'worker':
+        worker(sys.argv[2], sys.argv[3])
+    else:
+        _quickTest()
@@ -0,0 +1,299 @@
+'''
+Relay between many Nutmeg producers and any number of viewers.
+
+Producers connect to the relay as if it were a viewer, and send each update
+once. The relay keeps the latest state of every session, answers viewers'
+state requests itself, and forwards updates to each viewer, coalescing
+property updates that pile up for a viewer.
+
+Like a viewer, the relay asks every producer for its state when it starts,
+so producers which were already running are picked up too.
+
+Run with:
+```python -m pynutmeg.Relay --viewer tcp://localhost:43686 --viewer tcp://otherhost:43686```
+and point producers at it:
+```pynutmeg.init(address='tcp://relayhost', pub_port=43688, sub_port=43689)```
+'''
+from __future__ import print_function, division
+import zmq
+
+import argparse
+import json
+import time
+import itertools
+
+from collections import OrderedDict
+
+
+_producer_port = 43688
+_viewer = 'tcp://localhost:43686'
+
+# Commands kept in the state, and the suffix of their state key
+_stateful = { 'SetFigure': '', 'SetGui': '.GUI', 'SetProperty': '', 'SetParam': '', 'SetSeries': '.SERIES',
+              'SetTemplate': '.TEMPLATE', 'SetFigures': '.INSTANCES' }
+# Commands where only the latest message per target needs to reach a viewer
+_coalesced = ('SetProperty', 'SetParam')
+
+# Seconds for producers to reconnect before asking them all for their state
+_settle = 0.5
+# Seconds after asking a producer for its state before asking again, if it's still only pinging
+_request_retry = 0.5
+
+_request_state = json.dumps(dict(messageType='requestState')).encode()
+
+
+class _Entry(object):
+    def __init__(self, msg, frames, chunks):
+        self.msg = msg
+        self.frames = frames
+        self.chunks = chunks
+
+
+class _Viewer(object):
+    '''
+    Connection to a single viewer and the updates waiting to be sent to it.
+    '''
+    def __init__(self, context, address):
+        '''
+        :param address: Address the viewer listens on, e.g. tcp://localhost:43686. It publishes on the next port.
+        '''
+        host, port = address.rsplit(':', 1)
+        self.address = address
+
+        self.pub = context.socket(zmq.PUB)
+        self.pub.connect(address)
+
+        self.sub = context.socket(zmq.SUB)
+        self.sub.setsockopt(zmq.SUBSCRIBE, b'')
+        self.sub.connect('{}:{}'.format(host, int(port) + 1))
+
+        self.pending = OrderedDict()  # key -> [frames, state key or None]
+
+    def queue(self, key, frames, state_key=None):
+        '''
+        :param state_key: Key of the state entry which holds this update, if any.
+        '''
+        # Latest value moves to the end, like Nutmeg.update_state
+        self.pending.pop(key, None)
+        self.pending[key] = [frames, state_key]
+
+    def supersede(self, key, state_key):
+        '''
+        Mark a pending update as part of the state entry `state_key`.
+        '''
+        if key in self.pending:
+            self.pending[key][1] = state_key
+
+    def drop_stateful(self):
+        '''
+        Drop the pending updates which a replay of the state sends anyway.
+        Method invocations and chunks of streams still being sent are kept.
+        '''
+        for key, (frames, state_key) in list(self.pending.items()):
+            if state_key is not None:
+                del self.pending[key]
+
+    def flush(self):
+        for frames, _ in self.pending.values():
+            self.pub.send_multipart(frames)
+        self.pending.clear()
+
+
+class Relay(object):
+    '''
+    Sits between producers and viewers. See the module docstring.
+    '''
+    def __init__(self, viewers=(_viewer,), host='*', pub_port=_producer_port, sub_port=_producer_port + 1, interval=0.0):
+        '''
+        :param viewers: Addresses of the viewers to relay to.
+        :param host: Interface to accept producers on.
+        :param pub_port: Port producers publish to.
+        :param sub_port: Port producers subscribe to for replies.
+        :param interval: Seconds between sends to each viewer. Property updates arriving in between are coalesced.
+        '''
+        self.context = zmq.Context()
+        self.interval = interval
+
+        self.producer_in = self.context.socket(zmq.SUB)
+        self.producer_in.setsockopt(zmq.SUBSCRIBE, b'')
+        self.producer_in.bind('tcp://{}:{}'.format(host, pub_port))
+
+        self.producer_out = self.context.socket(zmq.PUB)
+        self.producer_out.bind('tcp://{}:{}'.format(host, sub_port))
+
+        self.viewers = [_Viewer(self.context, address) for address in viewers]
+
+        self.state = OrderedDict()  # (session, key) -> _Entry
+        self.streams = {}  # (session, stream) -> [(queue key, chunk frames)]
+        self.sessions = set()  # Sessions whose state has been received
+        self.requested = {}  # Session -> time its state was last requested
+        self.broadcast = False  # Whether every producer has been asked for its state
+        self.unique = itertools.count()
+        self.running = True
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self.producer_in, zmq.POLLIN)
+        for viewer in self.viewers:
+            poller.register(viewer.sub, zmq.POLLIN)
+
+        print("Relaying to:", ', '.join(viewer.address for viewer in self.viewers))
+        started = last_flush = time.time()
+        while self.running:
+            if not self.broadcast and time.time() - started >= _settle:
+                self._request_all()
+
+            timeout = 100 if self.interval <= 0 else max(1, int(self.interval * 1000))
+            for sock, _ in poller.poll(timeout):
+                if sock is self.producer_in:
+                    self._from_producer(sock.recv_multipart())
+                else:
+                    viewer = next(v for v in self.viewers if v.sub is sock)
+                    self._from_viewer(viewer, sock.recv_multipart())
+
+            now = time.time()
+            if now - last_flush >= self.interval:
+                for viewer in self.viewers:
+                    viewer.flush()
+                last_flush = now
+
+    def stop(self):
+        self.running = False
+
+    def _reply(self, session, **msg):
+        self.producer_out.send_multipart([session, json.dumps(msg).encode()])
+
+    def _request_all(self):
+        '''
+        Ask every connected producer for its state. Producers only ping when
+        they start, so this is the only way to pick up ones that were already
+        running.
+        '''
+        self.producer_out.send_multipart([b'Nutmeg', _request_state])
+        now = time.time()
+        # Any seen pinging so far have just been asked
+        for session in self.requested:
+            self.requested[session] = now
+        self.broadcast = True
+
+    def _from_producer(self, frames):
+        msg = json.loads(frames[1].decode())
+        command = msg['command']
+        session = msg.get('session', '')
+        session_bytes = session.encode()
+
+        if session not in self.sessions:
+            if command != 'Ping':
+                # Producers only send updates once their state is requested,
+                # so it's already sending its state to the relay
+                self.sessions.add(session)
+            elif not self.broadcast:
+                # It'll be asked along with all the others
+                self.requested.setdefault(session, 0)
+            elif time.time() - self.requested.get(session, 0) > _request_retry:
+                # Ask for its whole state once, after that it only sends each
+                # update once. Only ask again if it's still pinging long
+                # after, which means the request was missed.
+                self._reply(session_bytes, messageType='requestState')
+                self.requested[session] = time.time()
+
+        # The relay takes responsibility for delivery
+        if msg.get('id', -1) >= 0:
+            self._reply(session_bytes, messageType='success', id=msg['id'])
+
+        if command == 'Ping':
+            return
+
+        if command == 'Chunk':
+            stream = msg['binary'][0]['stream']
+            queue_key = next(self.unique)
+            self.streams.setdefault((session, stream), []).append((queue_key, frames))
+            self._forward(queue_key, frames)
+            return
+
+        chunks = []
+        for header in msg.get('binary', []):
+            if 'chunks' in header:
+                chunks.extend(self.streams.pop((session, header['chunks']['stream']), []))
+
+        key = None
+        if command in _stateful:
+            key = (session, msg['target'] + _stateful[command])
+            if command == 'SetSeries':
+                key += (tuple(msg['args'][0]),)
+            elif command == 'SetFigures':
+                key += (tuple(instance['handle'] for instance in msg['args'][0]),)
+            self.state.pop(key, None)
+            self.state[key] = _Entry(msg, frames, [chunk for _, chunk in chunks])
+
+            # Its chunks are now part of the state too
+            for viewer in self.viewers:
+                for queue_key, _ in chunks:
+                    viewer.supersede(queue_key, key)
+
+        if command in _coalesced:
+            self._forward(('msg',) + key, frames, state_key=key)
+        else:
+            self._forward(next(self.unique), frames, state_key=key)
+
+    def _forward(self, key, frames, skip=None, state_key=None):
+        for viewer in self.viewers:
+            if viewer is not skip:
+                viewer.queue(key, frames, state_key)
+
+    def _from_viewer(self, viewer, frames):
+        topic = frames[0]
+        msg = json.loads(frames[1].decode())
+        mtype = msg.get('messageType')
+
+        if mtype == 'requestState':
+            print("\tState requested by:", viewer.address)
+            # The replay brings the viewer up to date with everything else
+            viewer.drop_stateful()
+            self._replay(viewer)
+
+        elif mtype == 'success':
+            # Already acknowledged by the relay
+            pass
+
+        elif mtype == 'parameterUpdated':
+            # Keep it in the state, and share it with the other viewers
+            session = topic.decode()
+            target = '{}.{}.value'.format(msg['figureHandle'], msg['parameter'])
+            update = dict(command='SetParam', target=target, args=[msg['value']], session=session, binary=[], id=-1)
+            update_frames = [b'Nutmeg', json.dumps(update).encode(), b'']
+            key = (session, target)
+            self.state.pop(key, None)
+            self.state[key] = _Entry(update, update_frames, [])
+            self._forward(('msg',) + key, update_frames, skip=viewer, state_key=key)
+            self.producer_out.send_multipart(frames)
+
+        else:
+            self.producer_out.send_multipart(frames)
+
+    def _replay(self, viewer):
+        for entry in self.state.values():
+            for chunk in entry.chunks:
+                viewer.pub.send_multipart(chunk)
+            msg = dict(entry.msg, id=-1)
+            viewer.pub.send_multipart([entry.frames[0], json.dumps(msg).encode()] + entry.frames[2:])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Relay between Nutmeg producers and viewers")
+    parser.add_argument('--viewer', action='append', help="Viewer address, may be repeated (default: {})".format(_viewer))
+    parser.add_argument('--host', default='*', help="Interface to accept producers on")
+    parser.add_argument('--pub-port', type=int, default=_producer_port, help="Port producers publish to")
+    parser.add_argument('--sub-port', type=int, default=_producer_port + 1, help="Port producers subscribe to")
+    parser.add_argument('--interval', type=float, default=0.0, help="Seconds between sends to each viewer, coalescing property updates in between")
+    args = parser.parse_args(argv)
+
+    relay = Relay(args.viewer or [_viewer], args.host, args.pub_port, args.sub_port, args.interval)
+    try:
+        relay.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
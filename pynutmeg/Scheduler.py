@@ -0,0 +1,140 @@
+from __future__ import print_function, division
+import threading
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+class ComputeScheduler(object):
+    '''
+    Recompute `func` whenever any of the bound Parameters change, on a thread
+    or process pool, and publish only the freshest result to `output`.
+
+    Each change of parameter values is given an increasing generation number.
+    At most `workers` computations are in flight at once. Changes arriving
+    while the pool is busy are coalesced so that only the latest set of values
+    is computed next. Results whose parameter values were superseded while
+    they were being computed are discarded, so only the freshest result is
+    published and a slow computation can never overwrite a fresher one.
+
+    For example:
+    ```
+    sld = fig.parameter('sigma')
+    sched = ComputeScheduler(get_y, [sld], lambda y: fig.set('ax.blue', y=y))
+    ```
+    '''
+    def __init__(self, func, params, output, pool='thread', workers=1, drop_stale=True, start=True):
+        '''
+        :param func: Function called with the current value of each parameter in `params`, in order.
+        :param params: A Parameter, or list of Parameters, which trigger recomputation.
+        :param output: Callable which is given each fresh result to publish.
+        :param pool: 'thread', 'process', or an existing concurrent.futures.Executor.
+        :param workers: Maximum number of computations in flight at once.
+        :param drop_stale: If False, also publish results whose parameter values were superseded while they were being computed, as long as nothing newer has been published yet.
+        :param start: If True, compute once immediately with the current values.
+        '''
+        if not isinstance(params, (list, tuple)):
+            params = [params]
+
+        self.func = func
+        self.params = list(params)
+        self.output = output
+        self.workers = max(1, workers)
+        self.drop_stale = drop_stale
+
+        self._own_pool = False
+        if pool == 'thread':
+            self.pool = ThreadPoolExecutor(self.workers)
+            self._own_pool = True
+        elif pool == 'process':
+            self.pool = ProcessPoolExecutor(self.workers)
+            self._own_pool = True
+        else:
+            self.pool = pool
+
+        self.lock = threading.Lock()
+        self.publish_lock = threading.Lock()
+        self.generation = 0
+        self.published = 0
+        self.in_flight = 0
+        self.pending = False
+        self.running = True
+
+        for param in self.params:
+            param.register_callback(self.trigger)
+
+        if start:
+            self.trigger()
+
+    def trigger(self):
+        '''
+        Flag that the parameter values have changed. Called automatically by
+        the bound Parameters.
+        '''
+        with self.lock:
+            if not self.running:
+                return
+            self.generation += 1
+            if self.in_flight >= self.workers:
+                # Coalesce: the latest values are picked up once a worker frees
+                self.pending = True
+                return
+            job = self._take()
+
+        self._submit(*job)
+
+    def _take(self):
+        ''' Claim a worker for the current values. Must be called with self.lock held. '''
+        self.in_flight += 1
+        self.pending = False
+        return self.generation, [param.value for param in self.params]
+
+    def _submit(self, generation, values):
+        # Submitted outside of self.lock since the done callback may fire immediately
+        future = self.pool.submit(self.func, *values)
+        future.add_done_callback(lambda f: self._done(f, generation))
+
+    def _done(self, future, generation):
+        with self.lock:
+            self.in_flight -= 1
+            publish = generation > self.published and not future.cancelled()
+            if self.drop_stale and generation < self.generation:
+                publish = False
+            if publish:
+                self.published = generation
+
+            job = None
+            if self.pending and self.running:
+                job = self._take()
+
+        if job is not None:
+            self._submit(*job)
+
+        if not publish:
+            return
+
+        error = future.exception()
+        if error is not None:
+            print("WARNING: Scheduled computation failed")
+            traceback.print_exception(type(error), error, error.__traceback__)
+            return
+
+        with self.publish_lock:
+            # A newer result may have overtaken this one outside of self.lock
+            if generation == self.published:
+                self.output(future.result())
+
+    def stop(self, wait=True):
+        '''
+        Unbind from the parameters and shutdown the pool if it is owned by
+        this scheduler.
+        '''
+        with self.lock:
+            self.running = False
+            self.pending = False
+
+        for param in self.params:
+            param.unregister_callback(self.trigger)
+
+        if self._own_pool:
+            self.pool.shutdown(wait=wait)
@@ -0,0 +1,291 @@
+from __future__ import print_function, division
+import numpy as np
+
+import os
+import copy
+import shutil
+import tempfile
+import weakref
+
+from collections import OrderedDict
+
+from . import Columnar
+from .Columnar import Packed
+
+
+def _immutable(array):
+    '''
+    Whether an array can't be changed by anyone, including through a
+    writeable array that it is a view of.
+    '''
+    while isinstance(array, np.ndarray):
+        if array.flags.writeable:
+            return False
+        array = array.base
+    return array is None or isinstance(array, bytes)
+
+
+def _with_data(packed, data):
+    ''' The same Packed frame, holding `data` instead. '''
+    if data is packed.data:
+        return packed
+    packed = copy.copy(packed)
+    packed.data = data
+    return packed
+
+
+class _Spilled(object):
+    '''
+    Placeholder for an array which has been written out to a scratch file.
+    '''
+    def __init__(self, path, dtype, shape):
+        self.path = path
+        self.dtype = dtype
+        self.shape = shape
+
+    def load(self):
+        return np.memmap(self.path, dtype=self.dtype, mode='r', shape=self.shape)
+
+
+class _Entry(object):
+    def __init__(self, msg, nbytes):
+        self.msg = msg
+        self.nbytes = nbytes
+        self.paths = []
+
+
+class StateStore(object):
+    '''
+    Ordered store of the last message sent to each target, which is replayed
+    to the viewer when it requests the state.
+
+    Array payloads are accounted against a memory budget. When the budget is
+    exceeded, arrays of the least recently set targets are either spilled to
+    memory-mapped scratch files, which are only read back when the state is
+    replayed, or evicted from the state altogether.
+
+    Arrays can also be snapshot when they're set so that changing them in place
+    afterwards doesn't change what gets replayed. With `snapshot='copy'`
+    every array is copied. With `snapshot='cow'` only writeable arrays are
+    copied, and read-only arrays, which can't change under us, are shared.
+    np.memmap arrays are always shared and never count towards the budget,
+    since they're already backed by a file. The arrays of Packed frames are
+    treated the same way, and pandas and pyarrow columns are kept as the
+    arrays they would be sent as.
+    '''
+    def __init__(self, max_memory=None, snapshot=None, spill=True, spill_dir=None, min_size=1 << 16):
+        '''
+        :param max_memory: Budget in bytes for arrays held in memory. None for no limit.
+        :param snapshot: None to keep references to arrays, 'copy' or 'cow'.
+        :param spill: If True, spill arrays over budget to disk, otherwise evict their targets from the state.
+        :param spill_dir: Where to create the scratch directory. Defaults to the system's temp directory.
+        :param min_size: Arrays smaller than this (bytes) are never spilled.
+        '''
+        if snapshot not in (None, 'copy', 'cow'):
+            raise ValueError("snapshot must be None, 'copy' or 'cow'")
+
+        self.max_memory = max_memory
+        self.snapshot = snapshot
+        self.spill = spill
+        self.spill_dir = spill_dir
+        self.min_size = min_size
+
+        self.entries = OrderedDict()
+        self.memory = 0
+        self.scratch = None
+        self.spill_count = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, target):
+        return target in self.entries
+
+    def __getitem__(self, target):
+        return self._entry_msg(self.entries[target])
+
+    def get(self, target, default=None):
+        if target in self.entries:
+            return self[target]
+        return default
+
+    def keys(self):
+        return self.entries.keys()
+
+    def items(self):
+        '''
+        Iterate through (target, msg) in the order they were last set,
+        reloading any spilled arrays.
+        '''
+        for target, entry in list(self.entries.items()):
+            yield target, self._entry_msg(entry)
+
+    def _entry_msg(self, entry):
+        if entry.paths:
+            return self._load(entry.msg)
+        return entry.msg
+
+    def update(self, target, msg):
+        '''
+        Store `msg` as the latest message for `target`, which moves to the end
+        of the replay order.
+        '''
+        if self.snapshot is None and self.max_memory is None:
+            # No snapshots and no budget, so nothing needs to be tracked
+            self._discard(target)
+            self.entries[target] = _Entry(msg, 0)
+            return
+
+        msg, nbytes = self._snapshot(msg)
+        self._discard(target)
+        self.entries[target] = _Entry(msg, nbytes)
+        self.memory += nbytes
+
+        if self.max_memory is not None and self.memory > self.max_memory:
+            self._reduce()
+
+    def remove(self, target):
+        self._discard(target)
+
+    def clear(self):
+        for target in list(self.entries):
+            self._discard(target)
+
+    def _discard(self, target):
+        entry = self.entries.get(target)
+        if entry is None:
+            return
+
+        self.memory -= entry.nbytes
+        for path in entry.paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        del self.entries[target]
+
+    def _snapshot(self, value):
+        '''
+        Return a copy of the message structure with arrays snapshot according
+        to the policy, and the number of bytes held in memory by its arrays.
+        '''
+        if isinstance(value, np.memmap):
+            return value, 0
+
+        elif isinstance(value, np.ndarray):
+            if value.dtype == 'O':
+                return value, 0
+            if self.snapshot == 'copy' or (self.snapshot == 'cow' and not _immutable(value)):
+                value = value.copy()
+            return value, value.nbytes
+
+        elif isinstance(value, Packed):
+            data, nbytes = self._snapshot(value.data)
+            return _with_data(value, data), nbytes
+
+        elif isinstance(value, (list, tuple)):
+            total = 0
+            new_value = []
+            for sub_value in value:
+                sub_value, nbytes = self._snapshot(sub_value)
+                new_value.append(sub_value)
+                total += nbytes
+            return type(value)(new_value), total
+
+        elif isinstance(value, dict):
+            total = 0
+            new_value = {}
+            for key, sub_value in value.items():
+                new_value[key], nbytes = self._snapshot(sub_value)
+                total += nbytes
+            return new_value, total
+
+        elif Columnar.is_columnar(value):
+            return self._snapshot(Columnar.to_numpy(value))
+
+        else:
+            return value, 0
+
+    def _reduce(self):
+        '''
+        Spill or evict the arrays of the least recently set targets until the
+        store is back within budget.
+        '''
+        for target, entry in list(self.entries.items()):
+            if self.memory <= self.max_memory:
+                break
+            if entry.nbytes < self.min_size:
+                continue
+
+            if self.spill:
+                self.memory -= entry.nbytes
+                entry.msg, entry.nbytes = self._spill(entry.msg, entry.paths)
+                self.memory += entry.nbytes
+            else:
+                self._discard(target)
+
+    def _spill(self, value, paths):
+        '''
+        Write arrays of at least min_size to scratch files, returning the new
+        message structure and the bytes still held in memory.
+        '''
+        if isinstance(value, np.memmap):
+            return value, 0
+
+        elif isinstance(value, np.ndarray):
+            if value.dtype == 'O':
+                return value, 0
+            if value.nbytes < self.min_size or value.nbytes == 0:
+                return value, value.nbytes
+
+            path = os.path.join(self._scratch(), '{}.dat'.format(self.spill_count))
+            self.spill_count += 1
+            mapped = np.memmap(path, dtype=value.dtype, mode='w+', shape=value.shape)
+            mapped[...] = value
+            mapped.flush()
+            del mapped
+            paths.append(path)
+            return _Spilled(path, value.dtype, value.shape), 0
+
+        elif isinstance(value, Packed):
+            data, nbytes = self._spill(value.data, paths)
+            return _with_data(value, data), nbytes
+
+        elif isinstance(value, (list, tuple)):
+            total = 0
+            new_value = []
+            for sub_value in value:
+                sub_value, nbytes = self._spill(sub_value, paths)
+                new_value.append(sub_value)
+                total += nbytes
+            return type(value)(new_value), total
+
+        elif isinstance(value, dict):
+            total = 0
+            new_value = {}
+            for key, sub_value in value.items():
+                new_value[key], nbytes = self._spill(sub_value, paths)
+                total += nbytes
+            return new_value, total
+
+        else:
+            return value, 0
+
+    def _load(self, value):
+        if isinstance(value, _Spilled):
+            return value.load()
+        elif isinstance(value, Packed):
+            return _with_data(value, self._load(value.data))
+        elif isinstance(value, (list, tuple)):
+            return type(value)(self._load(sub_value) for sub_value in value)
+        elif isinstance(value, dict):
+            return { key: self._load(sub_value) for key, sub_value in value.items() }
+        else:
+            return value
+
+    def _scratch(self):
+        if self.scratch is None:
+            self.scratch = tempfile.mkdtemp(prefix='pynutmeg-', dir=self.spill_dir)
+            # Clean up the scratch files when the store goes away
+            weakref.finalize(self, shutil.rmtree, self.scratch, True)
+        return self.scratch
@@ -0,0 +1,265 @@
+from __future__ import print_function, division
+import numpy as np
+
+import os
+
+
+def _downsample(src, dst, chunk_rows):
+    '''
+    Fill dst with a 2x2 box downsample of src, working through src a band
+    of rows at a time. Odd edges are handled by repeating the last row/column.
+    '''
+    h, w = src.shape[:2]
+    chunk_rows = max(2, chunk_rows - chunk_rows % 2)
+    for r0 in range(0, h, chunk_rows):
+        band = np.asarray(src[r0:r0 + chunk_rows], dtype=np.float32)
+        _downsample_band(band, dst, r0 // 2, w)
+
+
+def _downsample_band(band, dst, out_row, w):
+    if band.shape[0] % 2:
+        band = np.concatenate([band, band[-1:]], axis=0)
+    if w % 2:
+        band = np.concatenate([band, band[:, -1:]], axis=1)
+
+    out = 0.25 * (band[0::2, 0::2] + band[1::2, 0::2] + band[0::2, 1::2] + band[1::2, 1::2])
+    if np.issubdtype(dst.dtype, np.integer):
+        out = np.rint(out)
+    dst[out_row:out_row + out.shape[0]] = out.astype(dst.dtype)
+
+
+class ImagePyramid(object):
+    '''
+    Mip pyramid of a large image, split into square tiles.
+
+    Level 0 is the source image, which may be an np.memmap. Each level after
+    that halves the resolution, until the whole image fits in a single tile.
+    Levels are built a band of rows at a time, and can be kept in
+    memory-mapped files under `cache_dir`.
+    '''
+    def __init__(self, image, tile_size=256, chunk_rows=1024, cache_dir=None):
+        '''
+        :param image: (H, W) or (H, W, C) array-like.
+        :param tile_size: Width and height of each tile in pixels.
+        :param chunk_rows: Number of rows processed at a time while building.
+        :param cache_dir: If given, store levels above 0 as memory-mapped files in this directory.
+        '''
+        self.tile_size = tile_size
+        self.chunk_rows = chunk_rows
+        self.cache_dir = cache_dir
+        self.levels = [image]
+
+        level = image
+        while max(level.shape[:2]) > tile_size:
+            h, w = level.shape[:2]
+            shape = ((h + 1) // 2, (w + 1) // 2) + tuple(level.shape[2:])
+            dst = self._alloc(len(self.levels), shape, image.dtype)
+            _downsample(level, dst, chunk_rows)
+            self.levels.append(dst)
+            level = dst
+
+    def _alloc(self, index, shape, dtype):
+        if self.cache_dir is None:
+            return np.empty(shape, dtype)
+        path = os.path.join(self.cache_dir, 'tiles_{}.dat'.format(index))
+        return np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+
+    @property
+    def shape(self):
+        return self.levels[0].shape
+
+    def grid(self, level):
+        '''
+        Number of (rows, cols) of tiles at `level`.
+        '''
+        h, w = self.levels[level].shape[:2]
+        return (h + self.tile_size - 1) // self.tile_size, (w + self.tile_size - 1) // self.tile_size
+
+    def tile(self, level, row, col):
+        '''
+        Pixels of a tile. Tiles on the right and bottom edges may be smaller.
+        '''
+        t = self.tile_size
+        return np.asarray(self.levels[level][row*t:(row + 1)*t, col*t:(col + 1)*t])
+
+    def level_for(self, view_width, screen_width):
+        '''
+        The coarsest level that still has at least one pixel per screen pixel
+        when `view_width` source pixels are shown across `screen_width`.
+        '''
+        if screen_width <= 0 or view_width <= screen_width:
+            return 0
+        level = int(np.floor(np.log2(view_width / screen_width)))
+        return min(max(level, 0), len(self.levels) - 1)
+
+    def tiles_in(self, level, x_min, x_max, y_min, y_max):
+        '''
+        Tiles at `level` overlapping the region, given in level 0 pixels.
+        '''
+        span = self.tile_size * 2**level
+        rows, cols = self.grid(level)
+        r0 = max(int(y_min // span), 0)
+        r1 = min(int(np.ceil(y_max / span)), rows)
+        c0 = max(int(x_min // span), 0)
+        c1 = min(int(np.ceil(x_max / span)), cols)
+        return [ (level, r, c) for r in range(r0, r1) for c in range(c0, c1) ]
+
+    def update_region(self, y0, y1, x0, x1, data=None):
+        '''
+        Rebuild the pyramid over the rows [y0, y1) and columns [x0, x1) of the
+        source, after writing `data` there if given.
+
+        :return: Set of (level, row, col) for every tile that changed.
+        '''
+        if data is not None:
+            self.levels[0][y0:y1, x0:x1] = data
+
+        dirty = set(self.tiles_in(0, x0, x1, y0, y1))
+        for level in range(1, len(self.levels)):
+            src = self.levels[level - 1]
+            # Grow the region to even bounds so whole 2x2 blocks are rebuilt
+            y0, x0 = y0 - y0 % 2, x0 - x0 % 2
+            y1, x1 = min(y1 + y1 % 2, src.shape[0]), min(x1 + x1 % 2, src.shape[1])
+
+            band = np.asarray(src[y0:y1, x0:x1], dtype=np.float32)
+            dst = self.levels[level]
+            view = dst[:, x0 // 2:(x1 + 1) // 2]
+            _downsample_band(band, view, y0 // 2, x1 - x0)
+
+            y0, y1, x0, x1 = y0 // 2, (y1 + 1) // 2, x0 // 2, (x1 + 1) // 2
+            span = 2**level
+            dirty.update(self.tiles_in(level, x0*span, x1*span, y0*span, y1*span))
+
+        return dirty
+
+
+class TiledImage(object):
+    '''
+    Send only the tiles of an ImagePyramid that are needed for the current
+    view of the axis, at the level matching the screen resolution.
+
+    Tiles the viewer already has are cached and not sent again, until the
+    region of the source they cover is changed with `update_region`, or the
+    viewer requests the state after reconnecting, when the visible tiles are
+    sent again.
+
+    The viewer's tiled image plot at `handle` is first given the layout of
+    the pyramid through its `width`, `height`, `tileSize` and `levels`
+    properties. Each tile is then sent by invoking:
+    ```
+    setTile({"level": l, "row": r, "col": c, "x": x, "y": y, "scale": s}, pixels)
+    ```
+    where (x, y) is the tile's top left corner in source pixels and `scale` is
+    the size of one of its pixels in source pixels. The level to draw is set
+    through its `level` property.
+    '''
+    def __init__(self, figure, handle, pyramid, screen_size=(1920, 1080)):
+        '''
+        :param figure: Figure containing the plot.
+        :param handle: Handle of the tiled image plot in the figure.
+        :param screen_size: (width, height) in screen pixels of the plot, used to pick the level.
+        '''
+        self.figure = figure
+        self.handle = handle
+        self.pyramid = pyramid
+        self.screen_size = screen_size
+
+        self.sent = set()
+        self.visible = set()
+        self.level = None
+        self.scheduler = None
+
+        h, w = pyramid.shape[:2]
+        self.figure.set(self.handle, width=w, height=h, tileSize=pyramid.tile_size, levels=len(pyramid.levels))
+        self.figure.nutmeg.register_state_callback(self._state_requested)
+
+    def _state_requested(self):
+        # Tiles are invoked rather than set, so they aren't part of the state
+        # and the viewer no longer has any of them
+        self.sent = set()
+        if self.level is not None:
+            self._send(self.level, sorted(self.visible))
+
+    def needed(self, x_min, x_max, y_min, y_max):
+        '''
+        Work out the level and tiles for a view, in source pixels.
+        :return: (level, visible tiles)
+        '''
+        level = self.pyramid.level_for(x_max - x_min, self.screen_size[0])
+        return level, self.pyramid.tiles_in(level, x_min, x_max, y_min, y_max)
+
+    def show(self, x_min, x_max, y_min, y_max):
+        '''
+        Send the tiles needed to show the given region, in source pixels.
+        '''
+        level, tiles = self.needed(x_min, x_max, y_min, y_max)
+        self._send(level, tiles)
+
+    def _send(self, level, tiles, loaded=None):
+        self.visible = set(tiles)
+        for key in tiles:
+            if key in self.sent:
+                continue
+            pixels = None if loaded is None else loaded.get(key)
+            self._send_tile(key, pixels)
+
+        if level != self.level:
+            self.level = level
+            self.figure.set(self.handle + '.level', level)
+
+    def _send_tile(self, key, pixels=None):
+        level, row, col = key
+        if pixels is None:
+            pixels = self.pyramid.tile(level, row, col)
+
+        scale = 2**level
+        span = self.pyramid.tile_size * scale
+        info = dict(level=level, row=row, col=col, x=col*span, y=row*span, scale=scale)
+        self.figure.invoke(self.handle + '.setTile', info, pixels)
+        self.sent.add(key)
+
+    def update_region(self, y0, y1, x0, x1, data=None):
+        '''
+        Update a region of the source image, then resend just the tiles that
+        changed and are in view. Others are resent when they come into view.
+        '''
+        dirty = self.pyramid.update_region(y0, y1, x0, x1, data)
+        self.sent -= dirty
+        for key in sorted(dirty & self.visible):
+            self._send_tile(key)
+
+    def follow(self, param, **kwargs):
+        '''
+        Update whenever `param`, holding [minX, maxX, minY, maxY] in source
+        pixels, changes. Tiles are loaded on a ComputeScheduler so only the
+        latest view is ever sent.
+        :param **kwargs: Passed on to ComputeScheduler.
+        '''
+        from .Scheduler import ComputeScheduler
+
+        def load(view):
+            if not view:
+                h, w = self.pyramid.shape[:2]
+                view = [0, w, 0, h]
+            level, tiles = self.needed(*view)
+            loaded = { key: self.pyramid.tile(*key) for key in tiles if key not in self.sent }
+            return level, tiles, loaded
+
+        def output(result):
+            self._send(*result)
+
+        self._stop_following()
+        self.scheduler = ComputeScheduler(load, [param], output, **kwargs)
+        return self.scheduler
+
+    def stop(self):
+        '''
+        Stop following the view, and stop resending tiles on reconnect.
+        '''
+        self.figure.nutmeg.unregister_state_callback(self._state_requested)
+        self._stop_following()
+
+    def _stop_following(self):
+        if self.scheduler is not None:
+            self.scheduler.stop()
+            self.scheduler = None
@@ -1 +1,2 @@
 from .Nutmeg import *
+from .Scheduler import ComputeScheduler
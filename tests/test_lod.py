@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from pynutmeg.LOD import LODSeries
+
+
+@pytest.fixture(scope='module')
+def series():
+    y = np.random.RandomState(0).randn(1 << 20)
+    y[654321] = 50.0
+    y[123456] = -50.0
+    return LODSeries(y)
+
+
+@pytest.mark.parametrize('max_points', [20, 100, 1000, 4000, 20000])
+def test_query_is_bounded(series, max_points):
+    x, y = series.query(-10, 1e9, max_points=max_points)
+    assert len(x) == len(y)
+    assert len(x) <= max_points
+
+
+@pytest.mark.parametrize('max_points', [20, 100, 4000])
+def test_query_keeps_extremes(series, max_points):
+    x, y = series.query(max_points=max_points)
+    assert y.max() == 50.0
+    assert y.min() == -50.0
+    assert np.all(np.diff(x) >= 0)
+
+
+def test_small_range_is_raw(series):
+    x, y = series.query(1000, 1100, max_points=4000)
+    assert np.array_equal(y, series.y[999:1101])
+    assert np.array_equal(x, np.arange(999, 1101))
+
+
+def test_positions():
+    y = np.arange(10000.0)
+    series = LODSeries(y, x0=5.0, dx=0.5, min_length=16)
+    x, _ = series.query(5.0, 10.0, max_points=100)
+    assert x[0] == 5.0
+    assert x[-1] <= 10.5
+
+    x, y = series.query(max_points=100)
+    assert len(x) <= 100
+    assert x[0] >= 5.0 and x[-1] <= 5.0 + 0.5 * 9999
+
+
+def test_explicit_x():
+    x = np.cumsum(np.full(5000, 2.0))
+    series = LODSeries(np.arange(5000.0), x=x, min_length=16)
+    qx, qy = series.query(x[100], x[200], max_points=1000)
+    assert qx[0] == x[99] and qx[-1] == x[200]
+
+    # Lines reach past the edges of the view
+    qx, qy = series.query(x[100] + 1, x[200] - 1, max_points=1000)
+    assert qx[0] < x[100] + 1 and qx[-1] > x[200] - 1
+
+
+def test_nan_gaps_do_not_swallow_blocks():
+    y = np.arange(4096.0)
+    y[:100] = np.nan
+    series = LODSeries(y, min_length=16)
+    _, qy = series.query(max_points=64)
+    assert np.isfinite(qy).all()
+
+
+def test_bad_input():
+    with pytest.raises(ValueError):
+        LODSeries(np.zeros((4, 4)))
+    with pytest.raises(ValueError):
+        LODSeries(np.zeros(4), x=np.zeros(3))
@@ -0,0 +1,123 @@
+import os
+
+import numpy as np
+import pytest
+
+from pynutmeg.Columnar import Packed
+from pynutmeg.State import StateStore
+
+
+def _msg(value):
+    return dict(command="SetProperty", args=[value])
+
+
+def test_replay_order_follows_latest_update():
+    state = StateStore()
+    state.update('fig', _msg(0))
+    state.update('fig.ax.x', _msg(1))
+    state.update('fig', _msg(2))
+    assert list(state.keys()) == ['fig.ax.x', 'fig']
+    assert state['fig']['args'] == [2]
+
+
+def test_remove_and_clear():
+    state = StateStore()
+    state.update('a', _msg(0))
+    state.update('b', _msg(1))
+    state.remove('a')
+    state.remove('missing')
+    assert list(state.keys()) == ['b']
+    state.clear()
+    assert len(state) == 0
+
+
+def test_snapshot_copy():
+    state = StateStore(snapshot='copy')
+    data = np.arange(4.0)
+    state.update('x', _msg(data))
+    data[:] = -1
+    assert np.array_equal(state['x']['args'][0], np.arange(4.0))
+
+
+def test_snapshot_cow_shares_read_only_arrays():
+    state = StateStore(snapshot='cow')
+    writeable = np.arange(4.0)
+    frozen = np.arange(4.0)
+    frozen.flags.writeable = False
+    state.update('w', _msg(writeable))
+    state.update('f', _msg(frozen))
+
+    assert state['w']['args'][0] is not writeable
+    assert state['f']['args'][0] is frozen
+
+
+def test_snapshot_cow_copies_read_only_views_of_writeable_arrays():
+    state = StateStore(snapshot='cow')
+    base = np.arange(4.0)
+    view = base[:]
+    view.flags.writeable = False
+    state.update('v', _msg(view))
+    base[:] = -1
+    assert np.array_equal(state['v']['args'][0], np.arange(4.0))
+
+
+def test_snapshot_packed():
+    state = StateStore(snapshot='copy')
+    data = np.arange(6.0).reshape(2, 3)
+    state.update('s', dict(command="SetSeries", args=[['a', 'b'], dict(y=Packed(data))]))
+    data[:] = -1
+    assert np.array_equal(state['s']['args'][1]['y'].data, np.arange(6.0).reshape(2, 3))
+    assert state.memory == data.nbytes
+
+
+def test_budget_spills_oldest_and_reloads():
+    state = StateStore(max_memory=1000, min_size=100)
+    state.update('old', _msg(np.arange(100.0)))
+    state.update('new', _msg(np.arange(100.0) + 1))
+
+    assert state.memory <= 1000
+    assert list(state.keys()) == ['old', 'new']
+
+    replayed = dict(state.items())
+    assert isinstance(replayed['old']['args'][0], np.memmap)
+    assert np.array_equal(replayed['old']['args'][0], np.arange(100.0))
+    assert np.array_equal(replayed['new']['args'][0], np.arange(100.0) + 1)
+
+
+def test_spill_files_removed_with_entry():
+    state = StateStore(max_memory=1000, min_size=100)
+    state.update('old', _msg(np.arange(100.0)))
+    state.update('new', _msg(np.arange(100.0)))
+    path = state.entries['old'].paths[0]
+    assert os.path.exists(path)
+
+    state.update('old', _msg(1))
+    assert not os.path.exists(path)
+
+
+def test_budget_evicts_without_spill():
+    state = StateStore(max_memory=1000, spill=False, min_size=100)
+    state.update('old', _msg(np.arange(100.0)))
+    state.update('new', _msg(np.arange(100.0)))
+    assert list(state.keys()) == ['new']
+    assert state.memory == 800
+
+
+def test_small_arrays_stay_in_memory():
+    state = StateStore(max_memory=10, min_size=1 << 16)
+    state.update('x', _msg(np.arange(100.0)))
+    assert state.entries['x'].paths == []
+    assert state.memory == 800
+
+
+def test_memmaps_are_not_counted(tmp_path):
+    mapped = np.memmap(str(tmp_path / 'data.f64'), np.float64, 'w+', shape=(100,))
+    state = StateStore(max_memory=10, snapshot='copy')
+    state.update('m', _msg(mapped))
+    assert state.memory == 0
+    assert state['m']['args'][0] is mapped
+
+
+def test_bad_snapshot_mode():
+    with pytest.raises(ValueError):
+        StateStore(snapshot='deep')
@@ -0,0 +1,71 @@
+import numpy as np
+
+from pynutmeg.Tiles import ImagePyramid
+
+
+def _image(h=600, w=520):
+    return np.random.RandomState(0).randint(0, 255, (h, w)).astype(np.uint8)
+
+
+def _rebuilt(image, tile_size):
+    return ImagePyramid(image.copy(), tile_size=tile_size)
+
+
+def test_levels_halve_until_one_tile():
+    pyramid = ImagePyramid(_image(), tile_size=64)
+    shapes = [level.shape for level in pyramid.levels]
+    assert shapes[0] == (600, 520)
+    assert shapes[1] == (300, 260)
+    assert max(shapes[-1]) <= 64
+    assert pyramid.grid(0) == (10, 9)
+
+
+def test_tiles_at_edges_are_smaller():
+    pyramid = ImagePyramid(_image(), tile_size=64)
+    assert pyramid.tile(0, 9, 8).shape == (600 - 9*64, 520 - 8*64)
+
+
+def test_cache_dir_matches_memory(tmp_path):
+    image = _image()
+    in_memory = ImagePyramid(image, tile_size=64)
+    cached = ImagePyramid(image, tile_size=64, cache_dir=str(tmp_path))
+    for a, b in zip(in_memory.levels, cached.levels):
+        assert np.array_equal(a, b)
+
+
+def test_update_region_matches_full_rebuild():
+    image = _image()
+    pyramid = ImagePyramid(image, tile_size=64)
+    patch = np.full((37, 51), 200, np.uint8)
+    pyramid.update_region(101, 138, 77, 128, patch)
+
+    expected = _rebuilt(pyramid.levels[0], 64)
+    for a, b in zip(pyramid.levels, expected.levels):
+        assert np.array_equal(a, b)
+
+
+def test_update_region_reports_dirty_tiles():
+    pyramid = ImagePyramid(_image(), tile_size=64)
+    dirty = pyramid.update_region(0, 10, 0, 10, np.zeros((10, 10), np.uint8))
+    assert (0, 0, 0) in dirty
+    for level in range(1, len(pyramid.levels)):
+        assert (level, 0, 0) in dirty
+    assert (0, 1, 1) not in dirty
+
+    dirty = pyramid.update_region(130, 140, 200, 210, np.zeros((10, 10), np.uint8))
+    assert (0, 2, 3) in dirty
+    assert (1, 1, 1) in dirty
+    assert (0, 0, 0) not in dirty
+
+
+def test_level_for():
+    pyramid = ImagePyramid(_image(), tile_size=64)
+    assert pyramid.level_for(500, 1000) == 0
+    assert pyramid.level_for(2000, 1000) == 1
+    assert pyramid.level_for(1e9, 1000) == len(pyramid.levels) - 1
+
+
+def test_tiles_in():
+    pyramid = ImagePyramid(_image(), tile_size=64)
+    assert pyramid.tiles_in(0, 0, 64, 0, 64) == [(0, 0, 0)]
+    assert pyramid.tiles_in(1, 0, 520, 0, 600) == [(1, r, c) for r in range(5) for c in range(5)]
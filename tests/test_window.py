@@ -0,0 +1,84 @@
+import threading
+import time
+
+from pynutmeg.Nutmeg import TaskWindow
+
+
+def _fill(window, start, count):
+    for task_id in range(start, start + count):
+        window.acquire()
+        window.sent(task_id)
+
+
+def test_fixed_window_survives_lost_acks():
+    window = TaskWindow(8, adaptive=False, timeout=0.05)
+    _fill(window, 0, 40)
+    assert int(window.size) == 8
+
+    for task_id in range(40, 1040):
+        window.acquire()
+        window.sent(task_id)
+        window.release(task_id)
+    assert int(window.size) == 8
+
+
+def test_adaptive_window_shrinks_on_lost_acks():
+    window = TaskWindow(8, adaptive=True, timeout=0.05)
+    _fill(window, 0, 40)
+    assert int(window.size) < 8
+
+
+def test_adaptive_window_grows_while_latency_is_low():
+    window = TaskWindow(2, adaptive=True, max_size=64)
+    for task_id in range(200):
+        window.acquire()
+        window.sent(task_id)
+        window.release(task_id)
+    assert window.size > 2
+
+
+def test_acquire_blocks_until_release():
+    window = TaskWindow(1, timeout=10)
+    _fill(window, 0, 1)
+
+    acquired = threading.Event()
+
+    def acquire():
+        window.acquire()
+        acquired.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    assert not acquired.wait(0.1)
+
+    window.release(0)
+    assert acquired.wait(1)
+    thread.join()
+
+
+def test_drain():
+    window = TaskWindow(4, timeout=10)
+    _fill(window, 0, 3)
+    assert not window.drain(0.05)
+
+    for task_id in range(3):
+        window.release(task_id)
+    assert window.drain(0.05)
+
+
+def test_drain_forgets_lost_acks():
+    window = TaskWindow(4, timeout=0.05)
+    _fill(window, 0, 3)
+    t0 = time.time()
+    assert window.drain(1)
+    assert time.time() - t0 < 0.5
+    assert int(window.size) == 4
+
+
+def test_cancel_gives_back_slots():
+    window = TaskWindow(2, timeout=10)
+    window.acquire()
+    window.cancel()
+    _fill(window, 0, 2)
+    window.cancel(0)
+    assert window.in_flight() == 1